@@ -0,0 +1,56 @@
+'''
+Benchmark of the start-up time of the pandastic command line tools. Each
+command is run in a fresh interpreter a few times and the wall time is reported.
+The file-driven run reads datasets from a file and filters them all out by
+regex, so it covers everything up to the first Rucio call. Neither it nor --help
+needs PanDA or Rucio, so they should start in well under a second (no grid proxy
+or network needed).
+
+Run from the repository root with:
+
+    python benchmarks/bench_startup.py [--repeat 5]
+'''
+import os, sys, time, argparse, subprocess, tempfile, statistics
+
+_src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+def time_command(cmd, repeat, env, cwd):
+    '''
+    Method to run a command several times and get its wall times (in seconds)
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(cmd, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            print(f"ERROR:: {' '.join(cmd)} failed:\n{result.stderr}")
+            return None
+    return times
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [_src, os.environ.get('PYTHONPATH')])))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dids_file = os.path.join(tmpdir, 'dids.txt')
+        with open(dids_file, 'w') as f:
+            f.writelines(f'user.bench:user.bench.{300000+i}.PhPy8EG.e8351_s3681_r13144_p5855.lvl0/\n' for i in range(1000))
+
+        commands = {
+            'data_manager --help':          [sys.executable, '-m', 'pandastic.cli.data_manager', '--help'],
+            'task_manager --help':          [sys.executable, '-m', 'pandastic.cli.task_manager', '--help'],
+            'data_manager find --fromfiles': [sys.executable, '-m', 'pandastic.cli.data_manager', 'find',
+                                              '-s', r'user\.nobody\..*', '--fromfiles', dids_file, '--outdir', tmpdir],
+            'import data_manager':          [sys.executable, '-c', 'import pandastic.cli.data_manager'],
+        }
+
+        print(f"{'command':<32} {'min [s]':>8} {'median [s]':>11}")
+        for name, cmd in commands.items():
+            times = time_command(cmd, args.repeat, env, tmpdir)
+            if times is None: continue
+            print(f"{name:<32} {min(times):>8.3f} {statistics.median(times):>11.3f}")
+
+if __name__ == '__main__':  run()
@@ -0,0 +1,57 @@
+'''
+Benchmark of the DID-mode tabulation in wip/pandastic_tabulate_jobs.py.
+Synthetic PanDA tasks are generated with a few output containers each, and
+process_data is timed for increasing numbers of tasks. The time per task
+should stay flat as the number of tasks grows (linear scaling).
+
+Run from the repository root with:
+
+    python benchmarks/bench_tabulate_jobs.py [--ntasks 12500 25000 50000 100000]
+'''
+import os, sys, io, time, random, argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'pandastic'))
+from wip.pandastic_tabulate_jobs import process_data
+
+_rtags = ['r9364', 'r10201', 'r10724']
+_steps = ['lvl0', 'lvl1', 'lvl2']
+
+def make_tasks(ntasks, seed=42):
+    '''
+    Method to generate synthetic tasks with output containers named like
+    user.<user>.<dsid>.<physics>.<tag>.<step>_out.root/
+    '''
+    rng = random.Random(seed)
+    tasks = []
+    for i in range(ntasks):
+        dsid = 300000 + rng.randrange(ntasks)
+        tag  = f"e{rng.randrange(1000, 9999)}_{rng.choice('as')}{rng.randrange(1000, 9999)}_{rng.choice(_rtags)}_p{rng.randrange(1000, 9999)}"
+        step = rng.choice(_steps)
+        datasets = []
+        for out in ['out', 'log', 'hist']:
+            cont = f'user.bench.{dsid}.PhPy8EG.{tag}.{step}_{out}.root/'
+            for part in range(2):
+                datasets.append({'type': 'output', 'containername': cont, 'datasetname': f'{cont[:-1]}_{part:03d}'})
+        datasets.append({'type': 'input', 'containername': f'mc16_13TeV.{dsid}.deriv/', 'datasetname': f'mc16_13TeV.{dsid}.deriv'})
+        tasks.append({'jeditaskid': i, 'taskname': f'user.bench.{dsid}.{tag}.{step}/', 'status': 'done', 'datasets': datasets})
+    return tasks
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ntasks', type=int, nargs='+', default=[12500, 25000, 50000, 100000])
+    args = parser.parse_args()
+
+    regexes = [rf'user\.bench\.\d+\..*\.{step}_out\.root/' for step in _steps]
+    labels  = _steps
+
+    print(f"{'ntasks':>8} {'time [s]':>10} {'us/task':>10}")
+    for ntasks in args.ntasks:
+        tasks = make_tasks(ntasks)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            process_data(tasks, False, labels, regexes, ['done'], memo={})
+        elapsed = time.perf_counter() - start
+        print(f"{ntasks:>8} {elapsed:>10.2f} {elapsed*1e6/ntasks:>10.1f}")
+
+if __name__ == '__main__':  run()
@@ -1,7 +1,7 @@
-import rucio
+import rucio.common.exception
 import re
 
-def add_rule(ds, rse, lifetime, scope, rulecl):
+def add_rule(ds, rse, lifetime, scope, rulecl, copies=1):
     '''
     Method to add a rule for a dataset
 
@@ -15,6 +15,8 @@ def add_rule(ds, rse, lifetime, scope, rulecl):
         Lifetime of the rule
     scope: str
         Scope of the dataset
+    copies: int
+        Number of copies the rule should make on the RSEs of the expression
 
     Returns
     -------
@@ -23,7 +25,7 @@ def add_rule(ds, rse, lifetime, scope, rulecl):
     '''
 
     try:
-        rule = rulecl.add_replication_rule([{'scope':scope, 'name': ds.replace('/','')}], 1, rse, lifetime = lifetime)
+        rule = rulecl.add_replication_rule([{'scope':scope, 'name': ds.replace('/','')}], copies, rse, lifetime = lifetime)
         print(f'INFO:: DS = {ds} \n RuleID: {rule[0]}')
         return rule[0]
 
@@ -1,22 +1,394 @@
+import os, time, threading
+import mmap, zlib, hashlib, zipfile
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import rucio.common.exception
 
-def upload_file(file, rses, scopes, lifetime, ds, uploadcl):
+def upload_options(file, rses, scopes, lifetime, ds):
+    '''
+    Method to get the upload client items to upload a file to every RSE in every scope
 
-    nuploads = 0
-    print("INFO:: Preparing uploads with lifetime ", lifetime, " seconds")
+    Parameters
+    ----------
+    file: str
+        Path of the file to upload
+    rses: iterable
+        RSEs to upload the file to
+    scopes: list
+        Scopes to upload the file in
+    lifetime: int
+        Lifetime of the uploaded file (in seconds)
+    ds: str
+        Dataset to attach the file to, None to not attach it to a dataset
+
+    Returns
+    -------
+    items: list
+        One upload item (dictionary) per scope and RSE
+    '''
+    items = []
     for scope in scopes:
         for rse in rses:
-            print(f"INFO:: Uploading the file {file} to RSE {rse} in scope {scope}")
-            options = {'path': file, 'rse': rse, 'scope': scope, 'lifetime': lifetime}
+            options = {'path': file, 'rse': rse, 'scope': scope, 'did_scope': scope, 'lifetime': lifetime}
             if ds is not None:
-                print("INFO:: File will be saved in dataset: ", ds)
                 options['dataset_name'] = ds
                 options['dataset_scope'] = scope
-            try:
-                uploadcl.upload([options])
-                nuploads += 1
-            except Exception as e:
-                print(f"ERROR:: Failed to upload file {file} to RSE {rse} in scope {scope}")
-                print(str(e))
-                continue
-
-    return nuploads
+            items.append(options)
+    return items
+
+def batch_items(items, batch_size=1):
+    '''
+    Method to group upload items going to the same dataset, scope and RSE
+    into batches, each uploaded with one call of the upload client.
+
+    Parameters
+    ----------
+    items: list
+        Upload items
+    batch_size: int
+        Maximum number of items in a batch
+
+    Returns
+    -------
+    batches: list
+        Lists of upload items
+    '''
+    key_to_items = defaultdict(list)
+    for item in items:
+        key_to_items[(item.get('dataset_scope'), item.get('dataset_name'), item['scope'], item['rse'])].append(item)
+    return [group[i:i+batch_size] for group in key_to_items.values() for i in range(0, len(group), batch_size)]
+
+def interleave_rses(batches):
+    '''
+    Method to order batches of upload items round-robin over their RSEs, so
+    that concurrent workers spread over the RSEs instead of queueing on one.
+
+    Parameters
+    ----------
+    batches: list
+        Lists of upload items going to the same RSE
+
+    Returns
+    -------
+    batches: list
+        The same batches, interleaved by RSE
+    '''
+    rse_to_batches = defaultdict(deque)
+    for batch in batches:
+        rse_to_batches[batch[0]['rse']].append(batch)
+    queues = deque(rse_to_batches.values())
+    interleaved = []
+    while queues:
+        queue = queues.popleft()
+        interleaved.append(queue.popleft())
+        if queue:   queues.append(queue)
+    return interleaved
+
+def upload_files(items, get_uploadcl, nworkers=1, max_per_rse=None, retries=1, throughput=None, batch_size=1):
+    '''
+    Method to upload many items with a pool of workers. Items going to the same
+    dataset, scope and RSE are uploaded together in batches of up to batch_size.
+    At most max_per_rse batches are uploaded at the same time on a given RSE.
+    Items of failed batches are retried in up to `retries` passes after the first one.
+
+    Parameters
+    ----------
+    items: list
+        Upload items as given by upload_options
+    get_uploadcl: callable
+        Function returning the upload client of the calling thread, e.g.
+        utils.rucio_clients.get_uploadcl
+    nworkers: int
+        Number of uploads to run concurrently
+    max_per_rse: int
+        Maximum number of concurrent uploads to the same RSE, None for no limit
+    retries: int
+        Number of passes to retry the failed items in
+    throughput: dict
+        If given, filled with the bytes uploaded to each RSE and the seconds
+        spent uploading them, as {rse: [bytes, seconds]}
+    batch_size: int
+        Maximum number of items uploaded with one call of the upload client
+
+    Returns
+    -------
+    (nuploads, failed): tuple
+        Number of successful uploads, and the items that still failed
+    '''
+    # Slots limiting the concurrent uploads to each RSE
+    rse_slots = {item['rse']: threading.BoundedSemaphore(max_per_rse or nworkers) for item in items}
+    throughput_lock = threading.Lock()
+
+    def upload(batch):
+        rse = batch[0]['rse']
+        with rse_slots[rse]:
+            start = time.time()
+            get_uploadcl().upload(batch)
+            elapsed = time.time()-start
+        size = sum(os.path.getsize(item['path']) for item in batch)
+        if throughput is not None:
+            with throughput_lock:
+                rse_throughput = throughput.setdefault(rse, [0, 0.])
+                rse_throughput[0] += size
+                rse_throughput[1] += elapsed
+        return size
+
+    nuploads, todo = 0, items
+    for attempt in range(retries+1):
+        if len(todo) == 0: break
+        if attempt > 0: print(f"INFO:: Retrying {len(todo)} failed uploads (pass {attempt}/{retries})")
+
+        batches = interleave_rses(batch_items(todo, batch_size))
+        failed, nbytes, ndone, start = [], 0, 0, time.time()
+        report_every = max(1, len(batches)//20)
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            futures = {executor.submit(upload, batch): batch for batch in batches}
+            for i, future in enumerate(as_completed(futures)):
+                batch = futures[future]
+                ndone += len(batch)
+                try:
+                    nbytes += future.result()
+                    nuploads += len(batch)
+                except Exception as e:
+                    ds = batch[0].get('dataset_name')
+                    print(f"ERROR:: Failed to upload {len(batch)} files {'of dataset '+ds+' ' if ds else ''}"
+                          f"to RSE {batch[0]['rse']} in scope {batch[0]['scope']}")
+                    print(str(e))
+                    failed.extend(batch)
+
+                if (i+1) % report_every == 0 or i+1 == len(batches):
+                    elapsed = max(time.time()-start, 1e-6)
+                    print(f"INFO:: Processed {ndone}/{len(todo)} uploads, {len(failed)} failed, "
+                          f"{nbytes/1e6:.1f} MB in {elapsed:.0f} s ({nbytes/1e6/elapsed:.2f} MB/s)")
+        todo = failed
+
+    return nuploads, todo
+
+def pick_primary_rse(rses, throughput):
+    '''
+    Method to pick the RSE to upload to, before replicating to the others.
+
+    Parameters
+    ----------
+    rses: list
+        Candidate RSEs, in order of preference
+    throughput: dict
+        Measured {rse: [bytes, seconds]} of earlier uploads
+
+    Returns
+    -------
+    primary: str
+        The candidate with the best measured throughput, or the first
+        candidate if none was measured
+    '''
+    measured = [rse for rse in rses if rse in throughput and throughput[rse][1] > 0]
+    if len(measured) == 0:  return rses[0]
+    return max(measured, key=lambda rse: throughput[rse][0]/throughput[rse][1])
+
+def file_checksums(path, block_size=1<<24):
+    '''
+    Method to compute the adler32 and md5 checksums of a file in one read
+    of the file through mmap, formatted like rucio does.
+
+    Parameters
+    ----------
+    path: str
+        Path of the file
+    block_size: int
+        Number of bytes given to the checksums at a time
+
+    Returns
+    -------
+    (path, adler32, md5): tuple
+        The path and its checksums as hex strings
+    '''
+    adler, md5 = 1, hashlib.md5()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        # Empty files cannot be mapped
+        if size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for start in range(0, size, block_size):
+                    block = view[start:start+block_size]
+                    adler = zlib.adler32(block, adler)
+                    md5.update(block)
+                    block.release()
+    return path, f'{adler:08x}', md5.hexdigest()
+
+def compute_checksums(paths, nprocs=None):
+    '''
+    Method to compute the checksums of many files with a pool of processes
+
+    Parameters
+    ----------
+    paths: list
+        Paths of the files
+    nprocs: int
+        Number of processes, default is the number of CPUs
+
+    Returns
+    -------
+    checksums: dict
+        Mapping from each path to its (adler32, md5) checksums
+    '''
+    checksums = {}
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        for path, adler, md5 in executor.map(file_checksums, paths, chunksize=16):
+            checksums[path] = (adler, md5)
+    return checksums
+
+def skip_registered(items, checksums, replicacl, chunk_size=1000):
+    '''
+    Method to remove the upload items whose file is already registered in rucio
+    with the same adler32 checksum and has an available replica on the RSE of
+    the item. The replicas are looked up in bulk, chunk_size files at a time.
+    If a lookup fails because some files are not registered yet, the files of
+    the chunk are looked up one by one, and the ones not found are uploaded.
+
+    Parameters
+    ----------
+    items: list
+        Upload items as given by upload_options
+    checksums: dict
+        Mapping from the paths of the items to their (adler32, md5) checksums
+    replicacl: rucio.client.replicaclient.ReplicaClient
+        Replica client to look the files up with
+    chunk_size: int
+        Number of files to look up in one call
+
+    Returns
+    -------
+    (to_upload, skipped): tuple
+        Items still to upload, and items skipped because they are already done
+    '''
+    def did_of(item):   return (item.get('did_scope', item['scope']), item.get('did_name', os.path.basename(item['path'])))
+
+    def lookup(chunk):
+        return [(replica['scope'], replica['name'], replica.get('adler32'), set(replica.get('rses', {}).keys()))
+                for replica in replicacl.list_replicas(chunk)]
+
+    dids = list(dict.fromkeys(did_of(item) for item in items))
+    # Adler32 checksum and RSEs with an available replica of each registered file
+    registered = {}
+    for start in range(0, len(dids), chunk_size):
+        chunk = [{'scope': scope, 'name': name, 'type': 'FILE'} for scope, name in dids[start:start+chunk_size]]
+        try:
+            replicas = lookup(chunk)
+        except rucio.common.exception.DataIdentifierNotFound:
+            replicas = []
+            for did in chunk:
+                try:    replicas.extend(lookup([did]))
+                except rucio.common.exception.DataIdentifierNotFound:   continue
+        for scope, name, adler, rses in replicas:
+            registered[(scope, name)] = (adler, rses)
+
+    to_upload, skipped, changed = [], [], set()
+    for item in items:
+        did = did_of(item)
+        if did not in registered:
+            to_upload.append(item)
+            continue
+        adler, rses = registered[did]
+        if str(adler).lstrip('0') != checksums[item['path']][0].lstrip('0'):
+            if did not in changed:
+                print(f"WARNING:: {item['path']} changed since {did[0]}:{did[1]} was registered, rucio will refuse to upload it")
+                changed.add(did)
+            to_upload.append(item)
+        elif item['rse'] in rses:
+            skipped.append(item)
+        else:
+            to_upload.append(item)
+
+    return to_upload, skipped
+
+def group_small_files(files, target_size):
+    '''
+    Method to split files into groups of about target_size bytes, each
+    packed into one archive.
+
+    Parameters
+    ----------
+    files: list
+        (path, size) tuples of the files of a dataset
+    target_size: int
+        Size in bytes a group should reach before a new one is started
+
+    Returns
+    -------
+    groups: list
+        Lists of paths, in the order of the sorted paths
+    '''
+    groups, group, group_size = [], [], 0
+    for path, size in sorted(files):
+        group.append(path)
+        group_size += size
+        if group_size >= target_size:
+            groups.append(group)
+            group, group_size = [], 0
+    if group:   groups.append(group)
+    return groups
+
+def pack_archive(archive, paths, block_size=1<<24):
+    '''
+    Method to pack files into a zip archive without compressing them, computing
+    the checksums of each file while it is copied. The entries are dated with
+    the modification times of the files so that packing the same files again
+    gives the same archive.
+
+    Parameters
+    ----------
+    archive: str
+        Path of the archive to write
+    paths: list
+        Paths of the files to pack, stored under their base names, which must be unique
+    block_size: int
+        Number of bytes copied at a time
+
+    Returns
+    -------
+    (archive, members): tuple
+        The archive path, and a list with the name, size, adler32 and md5
+        of each packed file as dictionaries
+    '''
+    names = [os.path.basename(path) for path in paths]
+    assert len(set(names)) == len(names), f"ERROR:: Files with the same name cannot be packed in {archive}"
+
+    members = []
+    os.makedirs(os.path.dirname(archive) or '.', exist_ok=True)
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for path in paths:
+            stat = os.stat(path)
+            info = zipfile.ZipInfo(os.path.basename(path), date_time=time.localtime(max(stat.st_mtime, 315619200))[:6])
+            info.file_size = stat.st_size
+            adler, md5 = 1, hashlib.md5()
+            with open(path, 'rb') as src, zf.open(info, 'w', force_zip64=stat.st_size >= 1<<31) as dst:
+                while True:
+                    block = src.read(block_size)
+                    if not block: break
+                    adler = zlib.adler32(block, adler)
+                    md5.update(block)
+                    dst.write(block)
+            members.append({'name': info.filename, 'bytes': stat.st_size, 'adler32': f'{adler:08x}', 'md5': md5.hexdigest()})
+    return archive, members
+
+def pack_archives(archives, nprocs=None):
+    '''
+    Method to pack many archives with a pool of processes, handing each one
+    over as soon as it is written.
+
+    Parameters
+    ----------
+    archives: dict
+        Mapping from the path of each archive to the paths of the files to pack in it
+    nprocs: int
+        Number of processes, default is the number of CPUs
+
+    Returns
+    -------
+    packed: generator
+        Generator of (archive, members) tuples as returned by pack_archive
+    '''
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        futures = [executor.submit(pack_archive, archive, paths) for archive, paths in archives.items()]
+        for future in as_completed(futures):
+            yield future.result()
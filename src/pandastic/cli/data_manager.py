@@ -13,15 +13,8 @@ import os, json, re, urllib3
 import argparse
 from datetime import datetime
 from collections import defaultdict
-# PanDA: /cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase/x86_64/PandaClient/1.5.9/lib/python3.6/site-packages/pandaclient/PBookCore.py
-from pandaclient import PBookCore
-from pandaclient import queryPandaMonUtils
-pbook = PBookCore.PBookCore()
-pbook.init()
 # Rucio
-from rucio import client as rucio_client
-import rucio
-import rucio.client.downloadclient as downloadclient
+import rucio.common.exception
 
 # Pandastic
 from pandastic.utils.tools import ( dataset_size, bytes_to_best_units, draw_progress_bar, get_lines_from_files, SetEncoder )
@@ -31,14 +24,7 @@ from pandastic.actions.replicate_actions import ( add_rule )
 from pandastic.actions.filelist_actions import ( list_replicas )
 from pandastic.actions.update_actions import ( get_ruleids_to_update, update_rule )
 from pandastic.utils.dataset_handlers import (DatasetHandler, RucioDatasetHandler, PandaDatasetHandler)
-
-# ===============  Rucio Clients ================
-rulecl     = rucio_client.ruleclient.RuleClient()
-didcl      = rucio_client.didclient.DIDClient()
-rsecl      = rucio_client.rseclient.RSEClient()
-replicacl  = rucio_client.replicaclient.ReplicaClient()
-
-downloadcl = downloadclient.DownloadClient()
+from pandastic.utils.rucio_clients import ( get_client, get_downloadcl )
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -55,7 +41,7 @@ _h_rule_or_replica_on_rse = 'Use if both replica_on_rse and rule_on_rse are used
 _h_scopes                 = 'Scopes to look for the DIDs in if --usetask is not used'
 _h_type                   = 'Type of dataset being processd .. is it the task input or output?'
 _h_days                   = 'The number of days in the past to look for jobs in'
-_h_users                  = 'The grid usernames under for which the jobs should be searched (often your normal name with spaces replaced by +)'
+_h_users                  = 'The grid usernames under for which the jobs should be searched (often your normal name with spaces replaced by +). Default is the user of the grid proxy'
 _h_life                   = 'How long is should the lifetime of the dataset be on its destination RSE'
 _h_did                    = 'Subset of the jobs following the pattern to keep'
 _h_submit                 = 'Should the code submit the replication jobs? Default is to run dry'
@@ -72,6 +58,7 @@ _h_nohist_on_rse          = 'Ignore datasets that has ever had rules on given RS
 _h_notinfiles             = 'Files containing lists of datasets to ignore'
 _h_maxlifeleft            = 'Maximum lifetime left for a rule to be processed (useful for update of rules)'
 _h_noscopeinout           = 'Do not use scope in dataset names stored in the output file'
+_h_stream                 = 'Stream the PanDA tasks one at a time instead of loading them all in memory (useful for large --days)'
 # ===============  Arg Parser Choices ===============================
 _choices_usetasks =  ['submitted', 'defined', 'activated',
                       'assigned', 'starting', 'running',
@@ -92,7 +79,7 @@ def argparser():
     parser.add_argument('-s', '--regex',              type=str,   required=True,   nargs='+',            help=_h_regex)
     parser.add_argument('-r', '--rses',               type=str,   nargs='+',                             help=_h_rses)
     parser.add_argument('-d', '--days',               type=int,   default=30,                            help=_h_days)
-    parser.add_argument('-u', '--grid-user',          nargs='+',  default=[pbook.username],              help=_h_users)
+    parser.add_argument('-u', '--grid-user',          nargs='+',                                         help=_h_users)
     parser.add_argument('-l', '--lifetime',           type=int,   default = 36000,                        help= _h_life)
     parser.add_argument('--did',                      nargs='+',                                         help=_h_did)
     parser.add_argument('--scopes',                   nargs='+',                                         help=_h_scopes)
@@ -113,6 +100,7 @@ def argparser():
     parser.add_argument('--noScopeInOut',             action='store_true',                               help=_h_noscopeinout)
     parser.add_argument('--downto',                   type=str,                                          help="Where to download to")
     parser.add_argument('--prod',                     action='store_true',                               help="Is this a production dataset")
+    parser.add_argument('--stream',                   action='store_true',                               help=_h_stream)
     return parser.parse_args()
 
 def run():
@@ -130,7 +118,7 @@ def run():
     rses      = rses if rses is not None else []
     usable_rses = set()
     for rse in rses:
-        usable_rses |= get_rses_from_regex(rse, rsecl)
+        usable_rses |= get_rses_from_regex(rse, get_client())
     if action != 'download' and action != 'find' and action != 'listfiles':
         assert len(usable_rses) > 0, "No RSEs found to replicate to. Exiting."
 
@@ -174,7 +162,8 @@ def run():
                                                   usetasks = usetasks,
                                                   ds_type  = args.type,
                                                   did  = args.did,
-                                                  production = args.prod)
+                                                  production = args.prod,
+                                                  stream = args.stream)
 
     else:
         # if --usetask is not used, the scopes must be specified
@@ -218,7 +207,7 @@ def run():
             # Try to get the size of the dataset, use as proxy to skip datasets
             # found from a task but not existing on Rucio...
             try:
-                totalsize_processed += dataset_size(did, scope, didcl)
+                totalsize_processed += dataset_size(did, scope, get_client())
             except rucio.common.exception.DataIdentifierNotFound:
                 print("WARNING:: Dataset not found in Rucio: ", did, "Skipping...")
                 continue
@@ -231,7 +220,7 @@ def run():
                         print("INFO:: Replicating to RSE: ", rse)
                         # Only really add the rule if --submit is used
                         if args.submit:
-                            ruleid = add_rule(did, rse, args.lifetime, scope, rulecl)
+                            ruleid = add_rule(did, rse, args.lifetime, scope, get_client())
                         else:
                             ruleid = 'NOT_SUBMITTED'
 
@@ -247,7 +236,7 @@ def run():
                 # Prepare in case a dataset has no rules
                 no_valid_rules = True
                 # Find the rules to delete and rses to delete them from
-                rule_ids_rses_zip = get_ruleids_to_delete(did, usable_rses, rses, scope, didcl)
+                rule_ids_rses_zip = get_ruleids_to_delete(did, usable_rses, rses, scope, get_client())
                 # Loop over the rules to delete and rse to delete them from
                 for ruleid, rse in rule_ids_rses_zip:
                     # If we are here, at least one rule was found for the dataset
@@ -259,7 +248,7 @@ def run():
 
                     # Only really delete the rule if --submit is used
                     if args.submit:
-                        success = delete_rule(ruleid, rulecl)
+                        success = delete_rule(ruleid, get_client())
                         if not success: continue
 
                     # Write to monitoring scripts
@@ -279,7 +268,7 @@ def run():
                 no_valid_rules = True
                 max_time_to_death = args.maxlifeleft
                 # Find the rules to update and rses to update them from
-                rule_ids_rses_zip = get_ruleids_to_update(did, usable_rses, rses, scope, max_time_to_death, didcl)
+                rule_ids_rses_zip = get_ruleids_to_update(did, usable_rses, rses, scope, max_time_to_death, get_client())
                 # Loop over the rules to update and rse to update them from
                 for ruleid, rse in rule_ids_rses_zip:
                     # If we are here, at least one rule was found for the dataset
@@ -291,7 +280,7 @@ def run():
 
                     # Only really update the rule if --submit is used
                     if args.submit:
-                        success = update_rule(ruleid, args.lifetime, rulecl)
+                        success = update_rule(ruleid, args.lifetime, get_client())
                         if not success: continue
                     # Write to monitoring scripts
                     dids_monit_file.write(f"{outds}\n")
@@ -317,11 +306,11 @@ def run():
                 dids_monit_file.write(f"{outds}\n")
                 if args.submit:
                     try:
-                        downloadcl.download_dids([items])
+                        get_downloadcl().download_dids([items])
                         nprocessed += 1
                     except rucio.common.exception.NotAllFilesDownloaded as e:    raise str(e)
             elif action == 'listfiles':
-                replicas = list_replicas(did, scope, rses, replicacl)
+                replicas = list_replicas(did, scope, rses, get_client())
                 json.dump(replicas, replica_monit_file, indent=4, cls=SetEncoder)
                 dids_monit_file.write(f"{outds}\n")
                 nprocessed += 1
@@ -2,19 +2,14 @@
 
 # Required Imports
 # System
-import sys, os, json, re
+import sys, os, json, re, time, math
 import argparse
 from datetime import datetime
 from collections import defaultdict
-# PanDA: /cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase/x86_64/PandaClient/1.5.9/lib/python3.6/site-packages/pandaclient/PBookCore.py
-from   pandaclient import PBookCore
-from   pandaclient import queryPandaMonUtils
-import pandaclient.Client as Client
-
-pbook = PBookCore.PBookCore()
-pbook.init()
 # Pandastic
-from pandastic.utils.tools import ( draw_progress_bar, merge_dicts )
+from pandastic.utils.tools import ( draw_progress_bar, merge_dicts, get_lines_from_files )
+from pandastic.utils.panda_clients import ( get_pbook )
+from pandastic.utils.matching import ( RegexMatcher )
 
 
 # ===============  ArgParsing  ===================================
@@ -22,7 +17,7 @@ from pandastic.utils.tools import ( draw_progress_bar, merge_dicts )
 _h_action     = 'The action to perform on the task'
 _h_regex      = 'A regex in the panda *taskname* to be used to find the jobs/datasets to delete rules for'
 _h_days       = 'The number of days in the past to look for jobs in'
-_h_users      = 'The grid usernames under for which the jobs should be searched (often your normal name with spaces replaced by +)'
+_h_users      = 'The grid usernames under for which the jobs should be searched (often your normal name with spaces replaced by +). Default is the user of the grid proxy'
 _h_usetasks   = 'Specify task statuses to look for here'
 _h_fromfiles  = 'Files containing lists of tasks to act on'
 _h_mincomp    = 'Minimum percentage completion for jobs that should be acted on'
@@ -31,6 +26,7 @@ _h_maxcomp    =  'Maximum percentage completion for jobs that should be acted on
 _h_submit     = 'Should the code submit the pausing/unpausing command'
 _h_outdir     = 'Output directory for the output files. Default is the current directory'
 _h_newargs    = 'New arguments to pass to the retry method'
+_h_watch      = 'Keep running and poll PanDA every WATCH seconds, acting only on tasks that newly entered the requested statuses'
 
 # ===============  Arg Parser Choices ===============================
 _choices_usetasks =  ['submitted', 'defined', 'activated',
@@ -51,12 +47,13 @@ def argparser():
     parser.add_argument('action',             choices=_action_choices,                 help=_h_action)
     parser.add_argument('-s', '--regexes',    type=str,   required=True,   nargs='+',  help=_h_regex)
     parser.add_argument('-d', '--days',       type=int,   default=30,                  help=_h_days)
-    parser.add_argument('-u', '--grid-user',  nargs='+',  default=[pbook.username],    help=_h_users)
+    parser.add_argument('-u', '--grid-user',  nargs='+',                               help=_h_users)
     parser.add_argument('--fromfiles',        type=str,   nargs='+',                   help=_h_fromfiles)
     parser.add_argument('--mincomp',          type=float,                              help=_h_mincomp)
     parser.add_argument('--maxcomp',          type=float,                              help=_h_maxcomp)
     parser.add_argument('--outdir',           type=str,   default='./',                help=_h_outdir)
     parser.add_argument('--submit',           action='store_true',                     help=_h_submit)
+    parser.add_argument('--watch',            type=int,   metavar='INTERVAL',          help=_h_watch)
 
     req_usetasks = 'unpause' not in sys.argv and '--fromfiles' not in sys.argv
     parser.add_argument('--usetasks',         nargs='+',  required=req_usetasks,
@@ -88,13 +85,20 @@ def run():
 
     assert (usetasks is not None) or (fromfiles is not None), "ERROR: Must specify either --usetasks or --fromfiles. Exiting."
 
+    if args.watch is not None:
+        assert fromfiles is None, "ERROR: --watch cannot be used with --fromfiles. Exiting."
+        watch(args, action, usetasks, outdir)
+        return
+
     to_act_on = []
+    urls = {}
 
     if fromfiles is not None:
         # Get the datasets from the files
         tasks = get_lines_from_files(fromfiles)
+        matcher = RegexMatcher(regexes)
         for task in tasks:
-            if not any(re.match(regex, task) for regex in regexes): continue
+            if not matcher.match_any(task): continue
             to_act_on.append(task)
 
     else:
@@ -102,25 +106,81 @@ def run():
         # ===========
         # If we are using PanDA tasks, get the task names
         # ===========
+        to_act_on, urls = get_tasks_from_panda(args.grid_user, args.days, usetasks, regexes)
 
-        users     = args.grid_user
-        days      = args.days
+    act_on_tasks(to_act_on, action, args, urls, outdir)
 
-        urls = {}
-        for user in users:
+def get_tasks_from_panda(users, days, usetasks, regexes):
+    '''
+    Method to query PanDA for the tasks of the users in the given statuses
+    and keep the ones whose taskname matches any of the regexes.
+
+    Parameters
+    ----------
+    users: list
+        Grid usernames to query tasks for, None for the user of the grid proxy
+    days: int
+        Number of days in the past to look for tasks in
+    usetasks: str
+        Task statuses joined by '|', or 'any'
+    regexes: list
+        Regexes to match the tasknames against
+
+    Returns
+    -------
+    tasks: list
+        List of matching tasks (dicts from the PanDA monitor)
+    urls: dict
+        Mapping from lower-case username to the PanDA monitor URL for the user
+    '''
+    from pandaclient import queryPandaMonUtils
 
-            print(f"INFO:: Looking for tasks with statuses {usetasks} on the grid for user {user} in the last {days} days")
-            if usetasks == "any": usetasks = None
-            # Find all PanDA jobs that are done for the user and period specified
-            _, url, tasks = queryPandaMonUtils.query_tasks( username=user, days=days, status=usetasks)
+    if users is None: users = [get_pbook().username]
+    tasks_found, urls = [], {}
+    matcher = RegexMatcher(regexes)
+    for user in users:
 
-            # Tell the user the search URL if they want to look
-            print(f"INFO:: PanDAs query URL: {url}")
-            tasks = [t for t in tasks if any(re.match(regex, t.get('taskname')) for regex in regexes)]
-            to_act_on.extend(tasks)
-            url = re.sub('status=.*&', '', url)
-            urls[user.lower()] = url.replace('json=1&', '')
+        print(f"INFO:: Looking for tasks with statuses {usetasks} on the grid for user {user} in the last {days} days")
+        if usetasks == "any": usetasks = None
+        # Find all PanDA jobs that are done for the user and period specified
+        _, url, tasks = queryPandaMonUtils.query_tasks( username=user, days=days, status=usetasks)
 
+        # Tell the user the search URL if they want to look
+        print(f"INFO:: PanDAs query URL: {url}")
+        tasks = [t for t in tasks if matcher.match_any(t.get('taskname'))]
+        tasks_found.extend(tasks)
+        url = re.sub('status=.*&', '', url)
+        urls[user.lower()] = url.replace('json=1&', '')
+
+    return tasks_found, urls
+
+def act_on_tasks(to_act_on, action, args, urls, outdir):
+    '''
+    Method to perform the action on a list of tasks and write the
+    monitoring and summary files.
+
+    Parameters
+    ----------
+    to_act_on: list
+        List of tasks (dicts from the PanDA monitor) to act on
+    action: str
+        The action to perform on the tasks
+    args: argparse.Namespace
+        The parsed command line arguments
+    urls: dict
+        Mapping from lower-case username to the PanDA monitor URL for the user
+    outdir: str
+        Directory to write the output files to
+
+    Returns
+    -------
+    acted_on: list
+        The taskids of the tasks the action was submitted for (empty without --submit)
+    failed: list
+        The taskids of the tasks the action failed for
+    incomplete: list
+        The taskids of the tasks skipped because of --mincomp/--maxcomp
+    '''
     # ==================================================== #
     # ================= Operate on tasks ============== #
     # ==================================================== #
@@ -128,6 +188,7 @@ def run():
     actual_op_summary = defaultdict(str)
     now = datetime.now().strftime("%Y%m%d_%H%M%S")
     nop = 0
+    acted_on, failed, incomplete = [], [], []
 
     # Prepare output files for monitoring
     tasks_monit_file   = open(f'{outdir}/monit_{action}_tasks_{now}.txt', 'w')
@@ -135,7 +196,6 @@ def run():
     taskids = defaultdict(list)
     # Loop over the datasets in scope
     for task in to_act_on:
-
             request_id     = task.get('reqid')
             taskname       = task.get('taskname')
             taskid         = task.get('jeditaskid')
@@ -151,10 +211,10 @@ def run():
             except ZeroDivisionError:
                 percentage_done = 0
 
-            if args.mincomp is not None:
-                if percentage_done < args.mincomp: continue
-            if args.maxcomp is not None:
-                if percentage_done > args.maxcomp: continue
+            if (args.mincomp is not None and percentage_done < args.mincomp) or \
+               (args.maxcomp is not None and percentage_done > args.maxcomp):
+                incomplete.append(taskid)
+                continue
 
             # Tell the user what we are doing
             print(f"INFO:: {action} the task {taskname} which is {percentage_done} % complete")
@@ -162,33 +222,38 @@ def run():
             if args.submit:
                 # Only really add the rule if --submit is used
                 if action == 'pause':
-                    try:    pbook.pause(taskid)
+                    try:    get_pbook().pause(taskid)
                     except Exception as e:
                         print(f"ERROR:: Failed to {action} task {taskname} with error {e}")
+                        failed.append(taskid)
                         continue
                 elif action == 'unpause':
-                    try:    pbook.resume(taskid)
+                    try:    get_pbook().resume(taskid)
                     except Exception as e:
                         print(f"ERROR:: Failed to {action} task {taskname} with error {e}")
+                        failed.append(taskid)
                         continue
                 elif action == 'retry':
                     if '--newargs' in sys.argv:
                         newargs  = json.loads(args.newargs)
                     else:
                         newargs = None
-                    try:    pbook.retry(taskid, newOpts=newargs)
+                    try:    get_pbook().retry(taskid, newOpts=newargs)
                     except Exception as e:
                         print(f"ERROR:: Failed to {action} task {taskname} with error {e}")
+                        failed.append(taskid)
                         continue
                 elif action == 'kill':
-                    try:    pbook.kill(taskid)
+                    try:    get_pbook().kill(taskid)
                     except Exception as e:
                         print(f"ERROR:: Failed to {action} task {taskname} with error {e}")
+                        failed.append(taskid)
                         continue
                 elif action == 'find':
                     pass
                 else:
                     raise ValueError(f"ERROR:: Action {action} not recognised")
+                acted_on.append(taskid)
 
             # Write to monitoring scripts
             tasks_monit_file.write(taskname+'\n')
@@ -216,4 +281,95 @@ def run():
     # Summarise to user
     print(f"INFO:: TOTAL NUMBER OF TASKS TO UNDERGO {action}: {nop}")
 
+    return acted_on, failed, incomplete
+
+def watch(args, action, usetasks, outdir):
+    '''
+    Method to keep polling PanDA every --watch seconds and act only on the
+    tasks that newly entered the requested statuses since the last poll.
+    Tasks the action was submitted for are remembered in a state file in
+    the output directory, so restarting the watcher does not act on them
+    again. Without --submit nothing is written to the state file. Tasks the
+    action failed for, or skipped because of their completion, are looked at
+    again at the next poll. A poll that fails (e.g. PanDA can't be reached)
+    is logged and its time window is polled again next time.
+
+    The first poll looks back --days days; later polls only look back
+    over the time elapsed since the previous poll (or since the poll of
+    the oldest task still to retry), as PanDA filters the task list by
+    modification time, i.e. by status changes.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The parsed command line arguments
+    action: str
+        The action to perform on the tasks
+    usetasks: str
+        Task statuses joined by '|', or 'any'
+    outdir: str
+        Directory to write the output files to
+    '''
+    interval = args.watch
+    state_file = f'{outdir}/watch_{action}_state.json'
+
+    # Map from taskid to the status change time of the task when it was acted on
+    acted_on = {}
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            acted_on = json.load(f)
+        print(f"INFO:: Loaded {len(acted_on)} tasks already acted on from {state_file}")
+
+    # Taskids which were in the requested statuses at the previous poll
+    in_status = set()
+    # Start of the first poll with failed tasks not acted on since
+    failed_since = None
+    days = args.days
+    while True:
+        poll_start = time.time()
+        retry = False
+        try:
+            tasks, urls = get_tasks_from_panda(args.grid_user, days, usetasks, args.regexes)
+
+            new_tasks = []
+            current = set()
+            for task in tasks:
+                taskid = str(task.get('jeditaskid'))
+                current.add(taskid)
+                # Skip tasks that did not change status since the last poll
+                if taskid in in_status: continue
+                # Skip tasks that we acted on already, unless they changed status since
+                if taskid in acted_on and acted_on[taskid] == task.get('statechangetime'): continue
+                new_tasks.append(task)
+            print(f"INFO:: {len(new_tasks)} out of {len(tasks)} tasks newly entered statuses {usetasks}")
+
+            failed, incomplete = [], []
+            if len(new_tasks) != 0:
+                taskid_to_changetime = {str(t.get('jeditaskid')): t.get('statechangetime') for t in new_tasks}
+                submitted, failed, incomplete = act_on_tasks(new_tasks, action, args, urls, outdir)
+                for taskid in submitted:
+                    acted_on[str(taskid)] = taskid_to_changetime[str(taskid)]
+                if len(submitted) != 0:
+                    with open(state_file, 'w') as f:
+                        json.dump(acted_on, f, indent=4)
+                if len(failed) != 0: print(f"WARNING:: {len(failed)} tasks failed, they will be retried at the next poll")
+
+            # Failed tasks and tasks not complete enough are not considered seen, so they are
+            # looked at again at the next poll. Tasks that dropped out of the poll are no longer tracked
+            in_status = current - {str(taskid) for taskid in failed + incomplete}
+            retry = len(failed) != 0
+        except Exception as e:
+            print(f"ERROR:: Failed to poll PanDA and act on the tasks with error {e}")
+            retry = True
+
+        if not retry:                   failed_since = None
+        elif failed_since is None:      failed_since = poll_start
+
+        # Only look back over the time since the last poll (or the oldest failure) from now on
+        since = poll_start if failed_since is None else failed_since
+        days = max(1, math.ceil((time.time() - since + interval)/86400))
+        print(f"INFO:: Sleeping for {interval} seconds before polling PanDA again")
+        time.sleep(interval)
+
+
 if __name__ == "__main__":  run()
@@ -8,17 +8,16 @@ from datetime import datetime
 from pprint import pprint
 from collections import defaultdict
 import logging
-# PanDA: /cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase/x86_64/PandaClient/1.5.9/lib/python3.6/site-packages/pandaclient/PBookCore.py
-from pandaclient import PBookCore
-from pandaclient import queryPandaMonUtils
-pbook = PBookCore.PBookCore()
 # Rucio
-from rucio import client as rucio_client
-import rucio
+import rucio.common.exception
 # Pandastic
 from pandastic.utils.tools import ( draw_progress_bar, get_lines_from_files )
 from pandastic.utils.common import ( has_replica_on_rse, has_rule_on_rse, has_rulehist_on_rse,
                      RulesAndReplicasReq)
+from pandastic.utils.task_stream import ( query_tasks_stream )
+from pandastic.utils.matching import ( RegexMatcher )
+from pandastic.utils.rucio_clients import ( get_client )
+from pandastic.utils.panda_clients import ( get_pbook )
 
 class DatasetHandler(object):
     """
@@ -43,10 +42,22 @@ class DatasetHandler(object):
         self.rules_replica_req = rules_replica_req
         self.fromfiles = fromfiles
 
-        self.rulecl = rucio_client.ruleclient.RuleClient()
-        self.didcl = rucio_client.didclient.DIDClient()
-        self.rsecl = rucio_client.rseclient.RSEClient()
-        self.replicacl = rucio_client.replicaclient.ReplicaClient()
+    # Rucio clients of the calling thread, created on first use
+    @property
+    def rulecl(self):
+        return get_client()
+
+    @property
+    def didcl(self):
+        return get_client()
+
+    @property
+    def rsecl(self):
+        return get_client()
+
+    @property
+    def replicacl(self):
+        return get_client()
 
     def PrintSummary(self):
         print(f'===================================')
@@ -63,13 +74,14 @@ class DatasetHandler(object):
         datasets = defaultdict(set)
         # Get the datasets from the files
         all_datasets = get_lines_from_files(self.fromfiles)
+        matcher = RegexMatcher(self.regexes)
         for ds in all_datasets:
             if ':' in ds:
                 scope, did = ds.split(':')
             else:
                 did = ds
                 scope = '.'.join(did.split('.')[:2])
-            if not any(re.match(regex, did) for regex in self.regexes):
+            if not matcher.match_any(did):
                 continue
             datasets[scope].add(did.strip())
         return datasets
@@ -233,20 +245,23 @@ class PandaDatasetHandler(DatasetHandler):
                  usetasks: list,
                  ds_type: str,
                  days: int = 30,
-                 users: list = [pbook.username],
+                 users: list = None,
                  did: list = None,
                  matchfiles: bool = False,
                  production: bool = False,
+                 stream: bool = False,
                  **kwargs):
 
         super().__init__(**kwargs)
         self.matchfiles = matchfiles
         self.days = days
-        self.panda_users = users
+        # Default to the user of the grid proxy
+        self.panda_users = users if users is not None else [get_pbook().username]
         self.type = ds_type
         self.did = did
         self.usetasks = usetasks
         self.production = production
+        self.stream = stream
     def PrintSummary(self):
         print(f'===================================')
         print(f'Summary of DatasetHandler object:')
@@ -262,6 +277,7 @@ class PandaDatasetHandler(DatasetHandler):
         print(f'PanDA days to consider: {self.days}')
         print(f'PanDA dataset type to consider: {self.type}')
         print(f'PanDA dataset DID regex to consider: {self.did}')
+        print(f'Stream PanDA tasks instead of loading them all: {self.stream}')
         if self.production:
             print(f'Looking for production datasets (assuming scope is dataXX_xxTeV or mcXX_xxTeV)')
         print(f'===================================')
@@ -272,8 +288,9 @@ class PandaDatasetHandler(DatasetHandler):
 
         Parameters
         ----------
-        tasks: list
-            List of jobs to search through
+        tasks: list or generator
+            List of jobs to search through. A generator can be used to stream
+            the jobs, in which case no progress bar is drawn.
 
         Returns
         -------
@@ -281,9 +298,10 @@ class PandaDatasetHandler(DatasetHandler):
             A dictionary of datasets to process with keys being scope and values being a set of dataset names
         '''
 
-        regexes = self.regexes
+        # Matchers to test the tasknames and dataset names against the regexes
+        task_matcher = RegexMatcher(self.regexes)
+        did_matcher  = RegexMatcher(self.did) if self.did is not None else None
         ds_type = self.type
-        did_regexes = self.did
         only_cont = self.only_cont
         matchfiles = self.matchfiles
         didcl = self.didcl
@@ -311,11 +329,14 @@ class PandaDatasetHandler(DatasetHandler):
         for i, task in enumerate(tasks):
 
             # =========  Progress Bar =========
-            draw_progress_bar(len(tasks), i, f'Progress for collecting dids from tasks')
+            if isinstance(tasks, list):
+                draw_progress_bar(len(tasks), i, f'Progress for collecting dids from tasks')
+            elif (i+1)%1000 == 0:
+                print(f"INFO:: Processed {i+1} tasks so far..")
             # Get the name of the task
             taskname = task.get("taskname")
             # Skip the task if it doesn't match the regex
-            if all(re.match(rf'{rgx}', taskname) is None for rgx in regexes):   continue
+            if not task_matcher.match_any(taskname):   continue
             # Get the datasets associated to the task
             task_datasets = task.get("datasets")
 
@@ -361,10 +382,10 @@ class PandaDatasetHandler(DatasetHandler):
                 if only_cont:   to_process = contname
 
                 # Check if the dataset/container name matches the DID regex
-                if did_regexes is not None:
+                if did_matcher is not None:
 
                     # Skip the dataset/container if it doesn't match the DID regex
-                    if all(re.match(did_regex, to_process)  is None for did_regex in did_regexes):
+                    if not did_matcher.match_any(to_process):
                         # If we are processing containers, we can optimise by
                         # adding the container to the hated_containers set
                         if only_cont:   hated_containers.add(to_process)
@@ -398,6 +419,7 @@ class PandaDatasetHandler(DatasetHandler):
         """
         This method will get the tasks from the Panda server
         """
+        if self.stream: return self.StreamTasksFromPanda()
 
         users = self.panda_users
         days  = self.days
@@ -414,6 +436,7 @@ class PandaDatasetHandler(DatasetHandler):
                 usetasks = None
             else:
                 usetasks = self.usetasks
+            from pandaclient import queryPandaMonUtils
             _, url, tasks = queryPandaMonUtils.query_tasks(username=user, days=days, status=usetasks)
 
             print(len(tasks), "tasks found")
@@ -424,6 +447,22 @@ class PandaDatasetHandler(DatasetHandler):
 
         return all_users_tasks
 
+    def StreamTasksFromPanda(self):
+        """
+        This method will yield the tasks from the Panda server one at a time,
+        keeping only the task and dataset fields used by pandastic
+        """
+
+        for user in self.panda_users:
+            print(f"INFO:: Streaming tasks which are {self.usetasks} on the grid for user {user} in the last {self.days} days")
+            usetasks = None if self.usetasks == "any" else self.usetasks
+            url, tasks = query_tasks_stream(username=user, days=self.days, status=usetasks)
+
+            # Tell the user the search URL if they want to look
+            print(f"INFO:: PanDAs query URL: {url}")
+
+            yield from tasks
+
     def GetDatasets(self):
         """
         This method will get the datasets from the tasks
@@ -0,0 +1,190 @@
+#!python3
+
+'''
+This module holds a matcher to test names (tasknames, DIDs) against many regexes.
+Instead of running every regex on every name, a literal string that any match
+must contain is extracted from each regex, and all literals are searched for at
+once with an Aho-Corasick automaton. Only the regexes whose literal is found
+in the name are then run on it.
+'''
+
+import re
+from collections import deque, defaultdict
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+def required_literal(regex):
+    '''
+    Method to get the longest literal string that must appear in any string
+    matched by the regex (with re.match). Only literals in the top-level
+    sequence of the regex are considered.
+
+    Parameters
+    ----------
+    regex: str
+        The regex to extract the literal from
+
+    Returns
+    -------
+    (literal, anchored): tuple
+        The literal (None if no literal could be extracted) and whether the
+        literal must be at the start of the matched string
+    '''
+    try:
+        parsed = sre_parse.parse(regex)
+    except re.error:
+        return (None, False)
+    # Case insensitive or verbose regexes do not have a fixed literal
+    if parsed.state.flags & (sre_constants.SRE_FLAG_IGNORECASE | sre_constants.SRE_FLAG_VERBOSE):
+        return (None, False)
+
+    runs, run, run_at_start = [], [], True
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if op is sre_constants.AT and av is sre_constants.AT_BEGINNING and not run:
+            continue
+        # Anything else breaks the current literal run
+        if run: runs.append((''.join(run), run_at_start))
+        run, run_at_start = [], False
+    if run: runs.append((''.join(run), run_at_start))
+
+    if len(runs) == 0:  return (None, False)
+    return max(runs, key=lambda r: len(r[0]))
+
+class AhoCorasick:
+    '''
+    Class to find which of a set of literal strings occur in a text
+    in one pass over the text.
+    '''
+    def __init__(self, literals):
+        self.literals = list(literals)
+        # Trie of the literals, failure links and the literals ending at each node
+        self.goto = [{}]
+        self.fail = [0]
+        self.out  = [[]]
+        for i, literal in enumerate(self.literals):
+            node = 0
+            for char in literal:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[node][char] = len(self.goto)-1
+                node = self.goto[node][char]
+            self.out[node].append(i)
+
+        # Breadth first pass to set the failure links
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def search(self, text):
+        '''
+        Method to find the literals occurring in the text
+
+        Parameters
+        ----------
+        text: str
+            The text to search in
+
+        Returns
+        -------
+        found: set
+            Indices of the literals found in the text
+        '''
+        found = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]: found.update(out[node])
+        return found
+
+class RegexMatcher:
+    '''
+    Class to match names against a list of regexes (with re.match semantics),
+    prefiltering the regexes with the literals they require.
+    '''
+    def __init__(self, regexes):
+        self.regexes  = list(regexes)
+        self.compiled = [re.compile(regex) for regex in self.regexes]
+
+        # Regexes for which no literal could be extracted are always run
+        self.always = []
+        literal_to_regexes = defaultdict(list)
+        for i, regex in enumerate(self.regexes):
+            literal, anchored = required_literal(regex)
+            if literal is None: self.always.append(i)
+            else:   literal_to_regexes[literal].append((i, anchored))
+
+        self.literals = list(literal_to_regexes.keys())
+        self.literal_to_regexes = [literal_to_regexes[literal] for literal in self.literals]
+        self.automaton = AhoCorasick(self.literals)
+
+    def candidates(self, name):
+        '''
+        Method to get the indices of the regexes that could match the name
+
+        Parameters
+        ----------
+        name: str
+            The name to match
+
+        Returns
+        -------
+        candidates: list
+            Sorted indices of the regexes that could match the name
+        '''
+        candidates = list(self.always)
+        for lit_idx in self.automaton.search(name):
+            literal = self.literals[lit_idx]
+            for i, anchored in self.literal_to_regexes[lit_idx]:
+                if anchored and not name.startswith(literal):  continue
+                candidates.append(i)
+        return sorted(candidates)
+
+    def matching(self, name):
+        '''
+        Method to get the indices of the regexes matching the name
+
+        Parameters
+        ----------
+        name: str
+            The name to match
+
+        Returns
+        -------
+        matching: list
+            Sorted indices of the regexes matching the name
+        '''
+        return [i for i in self.candidates(name) if self.compiled[i].match(name) is not None]
+
+    def match_any(self, name):
+        '''
+        Method to check if any of the regexes matches the name
+
+        Parameters
+        ----------
+        name: str
+            The name to match
+
+        Returns
+        -------
+        matched: bool
+            True if any regex matches the name, False otherwise
+        '''
+        return any(self.compiled[i].match(name) is not None for i in self.candidates(name))
@@ -0,0 +1,27 @@
+#!python3
+
+'''
+This module provides the PanDA book-keeping client used by pandastic. The client
+is created and initialised on first use rather than when pandastic is imported,
+so that runs which never talk to PanDA (e.g. --help or --fromfiles) don't check
+the grid proxy or contact the PanDA server.
+'''
+
+# The PBookCore instance, created on first use
+_pbook = None
+
+def get_pbook():
+    '''
+    Method to get the PanDA book-keeping client, creating and initialising it on first use.
+
+    Returns
+    -------
+    pbook: pandaclient.PBookCore.PBookCore
+        The initialised client
+    '''
+    global _pbook
+    if _pbook is None:
+        from pandaclient import PBookCore
+        _pbook = PBookCore.PBookCore()
+        _pbook.init()
+    return _pbook
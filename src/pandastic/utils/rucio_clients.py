@@ -0,0 +1,59 @@
+#!python3
+
+'''
+This module provides the Rucio clients used by pandastic. Clients are created
+lazily on first use and each thread gets its own, since a client is not safe to
+share across threads. A single rucio.client.Client serves the account, DID, RSE,
+replica and rule calls of a thread, so they all go through the same HTTP session
+(keeping its connections alive) and the same authentication token. New clients
+pick up the token cached on disk by the first one instead of authenticating again.
+'''
+
+import threading
+
+# Clients of each thread, created on first use
+_thread_clients = threading.local()
+
+def get_client():
+    '''
+    Method to get the Rucio client of the current thread, creating it on first use.
+
+    Returns
+    -------
+    client: rucio.client.Client
+        Client with the account, DID, RSE, replica and rule methods
+    '''
+    if not hasattr(_thread_clients, 'client'):
+        from rucio.client import Client
+        _thread_clients.client = Client()
+    return _thread_clients.client
+
+def get_uploadcl():
+    '''
+    Method to get the upload client of the current thread, creating it on first
+    use on top of the Rucio client of the thread.
+
+    Returns
+    -------
+    uploadcl: rucio.client.uploadclient.UploadClient
+        Upload client of the thread
+    '''
+    if not hasattr(_thread_clients, 'uploadcl'):
+        from rucio.client.uploadclient import UploadClient
+        _thread_clients.uploadcl = UploadClient(_client=get_client())
+    return _thread_clients.uploadcl
+
+def get_downloadcl():
+    '''
+    Method to get the download client of the current thread, creating it on first
+    use on top of the Rucio client of the thread.
+
+    Returns
+    -------
+    downloadcl: rucio.client.downloadclient.DownloadClient
+        Download client of the thread
+    '''
+    if not hasattr(_thread_clients, 'downloadcl'):
+        from rucio.client.downloadclient import DownloadClient
+        _thread_clients.downloadcl = DownloadClient(client=get_client())
+    return _thread_clients.downloadcl
@@ -0,0 +1,159 @@
+#!python3
+
+'''
+This module provides a streaming alternative to queryPandaMonUtils.query_tasks.
+The PanDA monitor response is parsed incrementally, one task at a time, and each
+task is projected on the fields pandastic uses before being handed over, so that
+the full list of tasks with all their datasets is never held in memory.
+'''
+
+import re, json, ssl, codecs
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+# Fields of a task and of its datasets that are kept when streaming
+TASK_FIELDS    = ('taskname', 'jeditaskid', 'status', 'nfiles', 'nfilesfinished', 'username',
+                  'reqid', 'statechangetime')
+DATASET_FIELDS = ('type', 'datasetname', 'containername')
+
+# A complete JSON string, a brace, or the opening quote of a string not fully read yet
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}"]', re.DOTALL)
+
+def iter_json_objects(chunks):
+    '''
+    Method to yield the objects of a JSON array one by one from an iterable
+    of text chunks. Only the object currently being read is kept in memory.
+
+    Parameters
+    ----------
+    chunks: iterable
+        Iterable of str chunks which concatenated give a JSON array of objects
+
+    Returns
+    -------
+    objects: generator
+        Generator of the decoded objects of the array
+    '''
+    buf = ''
+    depth, start, pos = 0, None, 0
+    for chunk in chunks:
+        buf += chunk
+        for match in _TOKEN.finditer(buf, pos):
+            token = match.group()
+            # String is cut by the end of the chunk, wait for the next chunk
+            if token == '"':   break
+            pos = match.end()
+            if token == '{':
+                if depth == 0: start = match.start()
+                depth += 1
+            elif token == '}':
+                depth -= 1
+                if depth == 0:
+                    yield json.loads(buf[start:pos])
+                    start = None
+        else:
+            pos = len(buf)
+
+        # Drop what was already read from the buffer
+        cut = start if start is not None else pos
+        buf = buf[cut:]
+        pos -= cut
+        if start is not None: start = 0
+
+def project_task(task, fields=TASK_FIELDS, ds_fields=DATASET_FIELDS):
+    '''
+    Method to keep only the given fields of a task and of its datasets.
+
+    Parameters
+    ----------
+    task: dict
+        Task as returned by the PanDA monitor
+    fields: tuple
+        Task fields to keep
+    ds_fields: tuple
+        Fields of each dataset of the task to keep
+
+    Returns
+    -------
+    projected: dict
+        Task with only the requested fields
+    '''
+    projected = {field: task.get(field) for field in fields}
+    projected['datasets'] = [{field: ds.get(field) for field in ds_fields} for ds in (task.get('datasets') or [])]
+    return projected
+
+def read_chunks(response, chunk_size=1<<20):
+    '''
+    Method to read a HTTP response as decoded text chunks.
+
+    Parameters
+    ----------
+    response: http.client.HTTPResponse
+        Response to read from
+    chunk_size: int
+        Number of bytes to read at a time
+
+    Returns
+    -------
+    chunks: generator
+        Generator of str chunks
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        data = response.read(chunk_size)
+        if not data: break
+        yield decoder.decode(data)
+    yield decoder.decode(b'', final=True)
+
+def query_tasks_stream(username=None, days=None, status=None, taskname=None, jeditaskid=None,
+                       limit=10000, fields=TASK_FIELDS, ds_fields=DATASET_FIELDS):
+    '''
+    Method to query the PanDA monitor for tasks like queryPandaMonUtils.query_tasks,
+    but parsing the response incrementally and keeping only the requested fields.
+
+    Parameters
+    ----------
+    username: str
+        Grid username to look for tasks of
+    days: int
+        Number of days in the past to look for tasks in
+    status: str
+        Task statuses joined by '|'
+    taskname: str
+        Taskname pattern to look for
+    jeditaskid: int
+        Task ID to look for
+    limit: int
+        Maximum number of tasks to return
+    fields: tuple
+        Task fields to keep
+    ds_fields: tuple
+        Fields of each dataset of the task to keep. If empty, the datasets
+        are not requested from the monitor at all
+
+    Returns
+    -------
+    url: str
+        The PanDA monitor query URL
+    tasks: generator
+        Generator of the projected tasks
+    '''
+    from pandaclient import queryPandaMonUtils
+
+    params = {'json': 1, 'limit': limit}
+    # Only have the monitor look up and send the datasets if they are kept
+    if ds_fields:   params['datasets'] = True
+    for key, value in [('username', username), ('days', days), ('status', status),
+                       ('taskname', taskname), ('jeditaskid', jeditaskid)]:
+        if value is not None:   params[key] = value
+
+    # Same URL, headers and SSL handling as queryPandaMonUtils.query_tasks
+    url = queryPandaMonUtils.baseMonURL + '/tasks/?' + urlencode(params)
+
+    def tasks():
+        context = ssl._create_unverified_context()
+        with urlopen(Request(url, headers=queryPandaMonUtils.HEADERS), context=context) as response:
+            for task in iter_json_objects(read_chunks(response)):
+                yield project_task(task, fields, ds_fields)
+
+    return url, tasks()
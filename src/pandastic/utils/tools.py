@@ -1,6 +1,14 @@
 #!python3
 
 import re, json
+
+# Default mapping from reconstruction (r) tags to MC campaigns
+RTAG_TO_CAMP = {'r9364': 'mc16a', 'r10201': 'mc16d', 'r10724': 'mc16e'}
+
+# Precompiled patterns to extract fields from dataset/job names
+_DSID_PATTERN = re.compile(r"\D(\d{6})\D")
+_TAG_PATTERN  = re.compile(r"(e\d+_(?P<sim>[as])\d+_r\d+_p\d+)")
+
 class SetEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, set):
@@ -151,29 +159,30 @@ def nested_dict_equal(d1, d2):
             return False
     return True
 
-def get_camp(string):
+def get_camp(string, rtag_to_camp=None):
     '''
     Method to get the campaign from a dataset name. The method looks
-    for r9364, r10201, r10724 in the dataset name and returns the
-    corresponding campaign. If none of these are found, 'unknown' is
-    returned.
+    for the r-tags of the rtag_to_camp table (by default r9364, r10201,
+    r10724) in the dataset name and returns the corresponding campaign.
+    If none of these are found, 'unknown' is returned.
 
     Parameters
     ----------
     string: str
         Dataset/Job name to get the campaign from
+    rtag_to_camp: dict
+        Mapping from r-tags to campaigns. Default is RTAG_TO_CAMP
 
     Returns
     -------
     campaign: str
-        Campaign name. Can be 'mc16a', 'mc16d', 'mc16e' or 'unknown'.
+        Campaign name. Can be 'mc16a', 'mc16d', 'mc16e' or 'unknown' with the default table.
 
     '''
-
-    if   re.findall("r9364",  string) != []: return 'mc16a'
-    elif re.findall("r10201", string) != []: return 'mc16d'
-    elif re.findall("r10724", string) != []: return 'mc16e'
-    else:   return 'unknown'
+    if rtag_to_camp is None: rtag_to_camp = RTAG_TO_CAMP
+    for rtag, campaign in rtag_to_camp.items():
+        if rtag in string: return campaign
+    return 'unknown'
 
 def get_dsid(string):
     '''
@@ -215,6 +224,50 @@ def get_tag(string):
     tag = tag[0]
     return tag
 
+def parse_names(names, rtag_to_camp=None):
+    '''
+    Method to extract the DSID, AMI tag, simulation type and campaign from
+    many dataset/job names at once. The extraction is vectorised with pandas
+    string methods and precompiled patterns, and gives the same results as
+    get_dsid, get_tag and get_camp applied name by name.
+
+    Parameters
+    ----------
+    names: list or pandas.Series
+        Dataset/Job names to parse
+    rtag_to_camp: dict
+        Mapping from r-tags to campaigns. Default is RTAG_TO_CAMP
+
+    Returns
+    -------
+    parsed: pandas.DataFrame
+        DataFrame with one row per name and columns 'name', 'dsid', 'tag',
+        'sim' (AFII, FS or unknown) and 'campaign' (unknown if no r-tag matches).
+        'dsid' and 'tag' are NaN when not found in the name.
+    '''
+    # pandas is slow to import, only pay for it when names are parsed
+    import pandas as pd
+
+    if rtag_to_camp is None: rtag_to_camp = RTAG_TO_CAMP
+    names = pd.Series(names, dtype=object).reset_index(drop=True)
+
+    parsed = pd.DataFrame({'name': names})
+    parsed['dsid'] = names.str.extract(_DSID_PATTERN, expand=False)
+    tags = names.str.extract(_TAG_PATTERN)
+    parsed['tag']  = tags[0]
+    parsed['sim']  = tags['sim'].map({'a': 'AFII', 's': 'FS'}).fillna('unknown')
+
+    # Like get_camp, the first r-tag of the table found in the name gives the campaign
+    campaign = pd.Series('unknown', index=names.index, dtype=object)
+    unknown  = pd.Series(True, index=names.index)
+    for rtag, camp in rtag_to_camp.items():
+        found = unknown & names.str.contains(rtag, regex=False, na=False)
+        campaign[found] = camp
+        unknown &= ~found
+    parsed['campaign'] = campaign
+
+    return parsed
+
 def progress_bar(items, processed_items=0, bar_length=20, msg='Progress'):
     '''
     Displays a progress bar.
@@ -228,7 +281,7 @@ def progress_bar(items, processed_items=0, bar_length=20, msg='Progress'):
     bar_length: int
         Length of the progress bar in characters (default=20).
     '''
-    percent = processed_items / items
+    percent = processed_items / items if items > 0 else 1
     hashes = '#' * int(percent * bar_length)
     spaces = ' ' * (bar_length - len(hashes))
     print(f"\r{msg}: [{hashes}{spaces}] {percent*100:.2f}%", end="\n")
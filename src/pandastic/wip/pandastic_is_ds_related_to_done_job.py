@@ -6,25 +6,21 @@ import argparse
 from datetime import datetime
 from pprint import pprint
 from collections import defaultdict
-# PanDA: /cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase/x86_64/PandaClient/1.5.9/lib/python3.6/site-packages/pandaclient/PBookCore.py
-from pandaclient import PBookCore
-from pandaclient import queryPandaMonUtils
-pbook = PBookCore.PBookCore()
-from rucio import client as rucio_client
-didcl = rucio_client.didclient.DIDClient()
-
 # # Pandastic
-from utils.tools import ( get_dsid, get_tag )
+from utils.tools import ( parse_names )
+from utils.panda_clients import ( get_pbook )
+from utils.task_stream import ( query_tasks_stream )
 
 # ===============  ArgParsing  ===================================
 # ===============  Arg Parser Help ===============================
 _h_didsfiles              = 'A space separated listo of text files where each line is a container that we need to check if it is related to a job in some status'
 _h_type                   = 'Type of dataset being deleted .. is it the task input or output?'
 _h_days                   = 'The number of days in the past to look for jobs in'
-_h_users                  = 'The grid usernames under for which the jobs should be searched (often your normal name with spaces replaced by +)'
+_h_users                  = 'The grid usernames under for which the jobs should be searched (often your normal name with spaces replaced by +). Default is the user of the grid proxy'
 _h_usetask                = 'Should the regex be used to filter PanDA jobs? Specify task statuses to look for here'
 _h_tags                   = 'A list of tags to look for in the taskname before we compare dsids and atlas tags with datasets'
 _h_outdir                 = 'Output directory for the output files. Default is the current directory'
+_h_chunksize              = 'Number of datasets read and parsed at a time'
 
 # ===============  Arg Parser Choices ===============================
 _choices_usetasks =  ['submitted', 'defined', 'activated',
@@ -43,8 +39,9 @@ def argparser():
     parser.add_argument('-s', '--didsfiles',          type=str,   required=True,   nargs='+',            help=_h_didsfiles)
     parser.add_argument('--usetask',                  nargs='+',  required=True, choices = _choices_usetasks,            help=_h_usetask)
     parser.add_argument('-d', '--days',               type=int,   default=30,                            help=_h_days)
-    parser.add_argument('-u', '--grid-user',          nargs='+',  default=[pbook.username],              help=_h_users)
+    parser.add_argument('-u', '--grid-user',          nargs='+',                                         help=_h_users)
     parser.add_argument('--outdir',                   type=str,   default='./',                          help=_h_outdir)
+    parser.add_argument('--chunksize',                type=int,   default=10000,                         help=_h_chunksize)
 
     return parser.parse_args()
 
@@ -68,49 +65,118 @@ def run():
         # Get jobs that are in specified statuses
         # ===========
 
-        users     = args.grid_user
+        users     = args.grid_user if args.grid_user is not None else [get_pbook().username]
         days      = args.days
 
-        all_tasks = []
+        # Index of the tasks by the (DSID, tag) in their names
+        key_to_tasks = defaultdict(list)
         for user in users:
             print(f"INFO:: Looking for tasks which are {usetasks} on the grid for user {user} in the last {days} days")
-            # Find all PanDA jobs that are done for the user and period specified
-            _, url, tasks = queryPandaMonUtils.query_tasks( username=user, days=days, status=usetasks)
-            tasks = filter_tasks(tasks, args.tags)
-            all_tasks.extend(tasks)
-
+            # Stream the PanDA jobs in the statuses for the user and period specified
+            url, tasks = query_tasks_stream(username=user, days=days, status=usetasks, fields=('taskname',), ds_fields=())
             # Tell the user the search URL if they want to look
             print(f"INFO:: PanDAs query URL: {url}")
 
-    all_dids = []
-    for file in didsfiles:
-        with open(file, 'r') as didf:
-            dids = didf.readlines()
-        all_dids.extend(dids)
-
-    dids_related_to_tasks = []
-    for did in all_dids:
-        dsid = get_dsid(did)
-        atlas_tag  = get_tag(did)
-        if any((dsid in task) and (atlas_tag in task) for task in all_tasks):
-            print(f"INFO:: Horray, dataset {did} is related to a job with status {usetasks}")
-            dids_related_to_tasks.append(did)
+            ntasks = index_tasks(filter_tasks(tasks, args.tags), key_to_tasks, args.chunksize)
+            print(f"INFO:: Indexed {ntasks} tasks of user {user}")
 
     now = datetime.now().strftime("%Y%m%d_%H__%M__%S")
+    nrelated = 0
     with open(f"{outdir}/dids_related_to_tasks_{now}.txt", 'w') as f:
-        for did in dids_related_to_tasks:
-            f.write(did)
+        for did, dsid, atlas_tag in parse_dids(didsfiles, args.chunksize):
+            if not isinstance(dsid, str) or not isinstance(atlas_tag, str):
+                print(f"WARNING:: Could not find a DSID and tag in dataset {did.strip()}... skipping")
+                continue
+            if (dsid, atlas_tag) in key_to_tasks:
+                print(f"INFO:: Horray, dataset {did} is related to a job with status {usetasks}")
+                f.write(did)
+                nrelated += 1
 
-    print(len(dids_related_to_tasks), "datasets are related to jobs with status", usetasks)
+    print(nrelated, "datasets are related to jobs with status", usetasks)
 
 def filter_tasks(tasks, tags):
-    filtered_tasks = []
     for task in tasks:
         if not any(tag in task.get('taskname') for tag in tags):
             continue
         else:
-            filtered_tasks.append(task.get('taskname'))
+            yield task.get('taskname')
 
-    return filtered_tasks
+def chunks(iterable, size):
+    '''
+    Method to split an iterable into lists of at most size elements
+
+    Parameters
+    ----------
+    iterable: iterable
+        Elements to split
+    size: int
+        Maximum number of elements in a list
+
+    Returns
+    -------
+    chunks: generator
+        Generator of lists of elements
+    '''
+    chunk = []
+    for elem in iterable:
+        chunk.append(elem)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:   yield chunk
+
+def index_tasks(tasknames, key_to_tasks, chunksize=10000):
+    '''
+    Method to add tasks to an index by the DSID and tag in their names,
+    parsing the names a chunk at a time.
+
+    Parameters
+    ----------
+    tasknames: iterable
+        Names of the tasks
+    key_to_tasks: dict
+        Index from (DSID, tag) to the names of the tasks, filled in place
+    chunksize: int
+        Number of names parsed at a time
+
+    Returns
+    -------
+    ntasks: int
+        Number of tasks read
+    '''
+    ntasks = 0
+    for chunk in chunks(tasknames, chunksize):
+        parsed = parse_names(chunk)
+        for taskname, dsid, atlas_tag in zip(chunk, parsed['dsid'], parsed['tag']):
+            if isinstance(dsid, str) and isinstance(atlas_tag, str):
+                key_to_tasks[(dsid, atlas_tag)].append(taskname)
+        ntasks += len(chunk)
+    return ntasks
+
+def parse_dids(didsfiles, chunksize=10000):
+    '''
+    Method to read the datasets from files line by line and get their DSIDs
+    and tags, parsing them a chunk at a time.
+
+    Parameters
+    ----------
+    didsfiles: list
+        Files with one dataset per line
+    chunksize: int
+        Number of datasets parsed at a time
+
+    Returns
+    -------
+    dids: generator
+        Generator of (line, dsid, tag), with dsid and tag NaN if not found
+    '''
+    def lines():
+        for file in didsfiles:
+            with open(file, 'r') as didf:
+                yield from didf
+
+    for chunk in chunks(lines(), chunksize):
+        parsed = parse_names(chunk)
+        yield from zip(chunk, parsed['dsid'], parsed['tag'])
 
 if __name__ == "__main__":  run()
@@ -2,28 +2,230 @@
 # System
 import sys, os, re, json
 import argparse
-# Rucio
-from rucio import client as rucio_client
+import time
+import numpy as np
+import pandas as pd
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+# Pandastic
+from utils.rucio_clients import ( get_client )
+
+# Rule IDs are 32 hex digits
+_RULE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+_h_file     = 'File with Rule IDs (1x per line)'
+_h_users    = 'Rucio accounts whose rules are listed to find the rules in the file. Default is the account of the Rucio client'
+_h_nthreads = 'Number of rules not owned by the accounts to look up concurrently'
+_h_watch    = 'Keep running and sample the locks of the rules every WATCH seconds, reporting the rate at which\
+               locks get OK and the time left for each RSE, until no lock is replicating'
+_h_samples  = 'CSV file the samples are appended to. Default is <file>_samples.csv next to the file with the IDs'
+_h_window   = 'Only use the samples of the last WINDOW seconds for the rates. Default is 6 watch intervals'
 
 def argparser():
-    parser = argparse.ArgumentParser()    
-    parser.add_argument('file', type=str, help='File with Rule IDs (1x per line)')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', type=str, help=_h_file)
+    parser.add_argument('-u', '--usrs',    nargs='+',                        help=_h_users)
+    parser.add_argument('--nthreads',      type=int, default=8,              help=_h_nthreads)
+    parser.add_argument('--watch',         type=int, metavar='INTERVAL',     help=_h_watch)
+    parser.add_argument('--samples',       type=str,                         help=_h_samples)
+    parser.add_argument('--window',        type=int,                         help=_h_window)
 
     return parser.parse_args()
 
+def get_rule(an_id):
+    """
+    Method to get a rule by its ID, None if it doesn't exist (anymore)
+    """
+    try:
+        return get_client().get_replication_rule(an_id)
+    except Exception:
+        return None
+
+def find_rules(ids, users, nthreads=8):
+    '''
+    Method to get the rules with the given IDs. The rules of the accounts are
+    streamed once and joined to the IDs, and the IDs not found in them are
+    looked up one by one concurrently.
+
+    Parameters
+    ----------
+    ids: list
+        Rule IDs to look for
+    users: list
+        Rucio accounts to list the rules of, None for the account of the client.
+        If no account is known, all the rules are looked up one by one
+    nthreads: int
+        Number of IDs to look up concurrently
+
+    Returns
+    -------
+    id_to_rule: dict
+        Mapping from each ID to its rule, or None if it was not found
+    '''
+    acccl = get_client()
+    if users is None:   users = [acccl.account] if getattr(acccl, 'account', None) else []
+    wanted = set(ids)
+    id_to_rule = {}
+    for usr in users:
+        if len(id_to_rule) == len(wanted): break
+        try:
+            for rule in acccl.list_account_rules(usr):
+                if rule['id'] in wanted:    id_to_rule[rule['id']] = rule
+        except Exception as e:
+            print(f"WARNING:: Could not list the rules of {usr} ({e}), looking up its rules one by one")
+
+    missing = [an_id for an_id in ids if an_id not in id_to_rule]
+    if len(missing) != 0:
+        print(f"INFO:: Looking up {len(missing)} rules not found in the rules of {users}")
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            id_to_rule.update(zip(missing, executor.map(get_rule, missing)))
+
+    return id_to_rule
+
+def sample_rules(ids, id_to_rule, now):
+    '''
+    Method to take a sample of the lock counts of the rules found
+
+    Parameters
+    ----------
+    ids: list
+        Rule IDs
+    id_to_rule: dict
+        Mapping from IDs to rules (or None)
+    now: float
+        Time of the sample (seconds since the epoch)
+
+    Returns
+    -------
+    sample: pandas.DataFrame
+        One row per rule with the time, id, rse (expression) and the
+        ok, replicating and stuck lock counts
+    '''
+    rules = [id_to_rule[an_id] for an_id in ids if id_to_rule.get(an_id) is not None]
+    return pd.DataFrame({'time':        np.full(len(rules), now),
+                         'id':          [rule['id'] for rule in rules],
+                         'rse':         [rule['rse_expression'] for rule in rules],
+                         'ok':          [rule['locks_ok_cnt'] for rule in rules],
+                         'replicating': [rule['locks_replicating_cnt'] for rule in rules],
+                         'stuck':       [rule['locks_stuck_cnt'] for rule in rules]})
+
+def rse_rates(samples, window=None):
+    '''
+    Method to get the rate at which locks get OK on each RSE and the time
+    left until no lock is replicating. The rate of each rule is the change
+    of its OK locks between its first and last samples in the window, and
+    the rate of an RSE is the sum of the rates of its rules.
+
+    Parameters
+    ----------
+    samples: pandas.DataFrame
+        Samples as returned by sample_rules, for any number of times
+    window: float
+        Only use the samples of the last `window` seconds, None to use all
+
+    Returns
+    -------
+    rates: pandas.DataFrame
+        Indexed by RSE, with the latest ok, replicating and stuck lock counts,
+        the rate (locks per hour) and the eta (hours, inf if the rate is 0)
+    '''
+    if window is not None:
+        samples = samples[samples['time'] >= samples['time'].max() - window]
+    by_rule = samples.sort_values('time', kind='stable').groupby('id')
+    first, last = by_rule.first(), by_rule.last()
+
+    elapsed = (last['time'] - first['time']).to_numpy(dtype=float)
+    gained  = (last['ok'] - first['ok']).to_numpy(dtype=float)
+    rate = np.divide(gained, elapsed, out=np.zeros(len(elapsed)), where=elapsed > 0) * 3600
+
+    per_rule = last[['rse', 'ok', 'replicating', 'stuck']].assign(rate=rate)
+    rates = per_rule.groupby('rse').sum()
+    rates['eta'] = np.divide(rates['replicating'].to_numpy(dtype=float), rates['rate'].to_numpy(dtype=float),
+                             out=np.full(len(rates), np.inf), where=rates['rate'].to_numpy(dtype=float) > 0)
+    rates.loc[rates['replicating'] == 0, 'eta'] = 0.
+    return rates
+
+def print_rates(rates):
+    """
+    Method to print the rates and time left per RSE
+    """
+    print(f"{'RSE':<40} {'OK':>8} {'REPL':>8} {'STUCK':>8} {'locks/h':>10} {'ETA':>10}")
+    for rse, row in rates.iterrows():
+        eta = 'unknown' if np.isinf(row['eta']) else f"{row['eta']:.1f} h"
+        print(f"{rse:<40} {int(row['ok']):>8} {int(row['replicating']):>8} {int(row['stuck']):>8} "
+              f"{row['rate']:>10.1f} {eta:>10}")
+
+def watch(ids, args):
+    '''
+    Method to keep sampling the lock counts of the rules every --watch seconds,
+    appending the samples to a CSV file and reporting the rates and times left
+    per RSE, until no lock is replicating anymore. Samples already in the file
+    from an earlier run are used for the rates too.
+
+    Parameters
+    ----------
+    ids: list
+        Rule IDs to watch
+    args: argparse.Namespace
+        The parsed command line arguments
+    '''
+    interval = args.watch
+    window   = args.window if args.window is not None else 6*interval
+    samples_file = args.samples if args.samples is not None else f'{os.path.splitext(args.file)[0]}_samples.csv'
+
+    samples = None
+    if os.path.exists(samples_file):
+        samples = pd.read_csv(samples_file)
+        samples = samples[samples['id'].isin(ids)]
+        print(f"INFO:: Loaded {len(samples)} earlier samples from {samples_file}")
+
+    while True:
+        now = time.time()
+        sample = sample_rules(ids, find_rules(ids, args.usrs, args.nthreads), now)
+        sample.to_csv(samples_file, mode='a', header=not os.path.exists(samples_file), index=False)
+        # Rules which are gone (e.g. expired) are not counted anymore
+        if samples is not None:
+            samples = samples[(samples['time'] >= now - window) & samples['id'].isin(sample['id'])]
+            sample  = pd.concat([samples, sample], ignore_index=True)
+        samples = sample
+
+        rates = rse_rates(samples, window)
+        print(f"=========================== {time.strftime('%d/%m/%Y %H:%M:%S')} ===========================")
+        print_rates(rates)
+        nreplicating = int(rates['replicating'].sum())
+        if nreplicating == 0:
+            print("INFO:: No lock is replicating anymore, stopping")
+            return
+
+        print(f"INFO:: {nreplicating} locks replicating, sampling again in {interval} seconds")
+        time.sleep(interval)
+
 def run():
-    
-    rcl = rucio_client.ruleclient.RuleClient()
-    
+
     args = argparser()
     ids_file = args.file
     with open(ids_file, 'r') as f:
         ids = f.readlines()
         ids = [x.strip() for x in ids]
-    
+
+    # Skip blank lines and placeholders like NOT_SUBMITTED
+    invalid = [an_id for an_id in ids if _RULE_ID.match(an_id) is None]
+    if len(invalid) != 0: print(f"WARNING:: Skipping {len(invalid)} lines which are not rule IDs")
+    ids = list(dict.fromkeys(an_id for an_id in ids if _RULE_ID.match(an_id) is not None))
+
+    if args.watch is not None:
+        watch(ids, args)
+        return
+
+    id_to_rule = find_rules(ids, args.usrs, args.nthreads)
+
+    state_counts, lock_counts, nmissing = Counter(), Counter(), 0
     for an_id in ids:
-        rule = next(rcl.list_replication_rules(filters={'id': an_id}), None)
-        if rule is None: print(f"WARNING:: No rule found with ID {an_id}... maybe it is past the rule lifetime? "); continue 
+        rule = id_to_rule.get(an_id)
+        if rule is None:
+            print(f"WARNING:: No rule found with ID {an_id}... maybe it is past the rule lifetime? ")
+            nmissing += 1
+            continue
         ok_count    = rule['locks_ok_cnt']
         repl_count  = rule['locks_replicating_cnt']
         stuck_count = rule['locks_stuck_cnt']
@@ -37,4 +239,13 @@ def run():
         print(f"    Last updated: {last_update}")
         print(f"==================================================================================")
 
-if __name__ == "__main__":  run()
\ No newline at end of file
+        state_counts[rule['state']] += 1
+        lock_counts.update({'OK': ok_count, 'REPLICATING': repl_count, 'STUCK': stuck_count})
+
+    print(f"==================================== Summary =====================================")
+    print(f"Rules: {len(ids)} ({nmissing} not found)")
+    for state in ['OK', 'REPLICATING', 'STUCK'] + sorted(set(state_counts) - {'OK', 'REPLICATING', 'STUCK'}):
+        print(f"    {state} = {state_counts[state]} rules, {lock_counts[state]} locks")
+    print(f"==================================================================================")
+
+if __name__ == "__main__":  run()
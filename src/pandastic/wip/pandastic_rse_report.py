@@ -6,22 +6,19 @@ using up this space
 # System
 import os, json, re
 import argparse
-from datetime import datetime
+import sqlite3
+import heapq
+import numpy as np
+from datetime import datetime, timezone
 from collections import defaultdict
-# Rucio
-from rucio import client as rucio_client
+from concurrent.futures import ThreadPoolExecutor
 RUCIO_USER = os.environ.get('RUCIO_ACCOUNT')
 # Pandastic
 from utils.tools import  ( dataset_size, bytes_to_best_units, draw_progress_bar )
-from utils.common import (  get_rses_from_regex, has_rule_on_rse)
+from utils.common import (  get_rses_from_regex )
 from utils.dataset_handlers import (DatasetHandler, RucioDatasetHandler, PandaDatasetHandler)
+from utils.rucio_clients import ( get_client )
 
-# ===============  Rucio Clients ================
-rulecl    = rucio_client.ruleclient.RuleClient()
-didcl     = rucio_client.didclient.DIDClient()
-rsecl     = rucio_client.rseclient.RSEClient()
-replicacl = rucio_client.replicaclient.ReplicaClient()
-acccl     = rucio_client.accountclient.AccountClient()
 # ===============  ArgParsing  ===================================
 # ===============  Arg Parser Help ===============================
 _h_regex                  = 'A regex in the rucio dataset/container name to be used to find the datasets'
@@ -34,6 +31,18 @@ _h_breakdown              = 'Get an extensive summary about datasets using the s
 _h_tags                   = 'To get a breakdown of the space used by different regexes, specify them here'
 _h_containers             = 'Should the code only process containers? Default is to process individual datasets.\
                              DID regex will be used to match the container name.'
+_h_nthreads               = 'Number of DIDs (or RSEs in the summary) to evaluate concurrently'
+_h_top                    = 'Only keep the K largest DIDs of each RSE in memory and in rse_<RSE>_dids_sizes.txt.\
+                             The histogram of the sizes in rse_<RSE>_size_histogram.json still covers all DIDs'
+_h_history                = 'SQLite file to append the per-RSE usage and per-DID sizes of this run to, as a new snapshot'
+_h_since                  = 'Also report the changes (new, grown, shrunk and removed DIDs, usage per RSE) since a snapshot\
+                             in --history: "last" for the previous snapshot, or a date (YYYY-MM-DD[THH:MM:SS], UTC)\
+                             for the last snapshot taken before it. The sizes in that snapshot are reused for DIDs whose\
+                             rules did not change since it was taken, so they miss files attached or detached since\
+                             without a rule change. Only snapshots taken with the same users, regexes, scopes, RSEs,\
+                             --containers and --fromrules are compared to'
+_h_fromrules              = 'Build the breakdown from the rules of the users (their bytes and locks) instead of listing\
+                             the files of every DID. File listings are only used for rules without a byte count'
 
 
 def argparser():
@@ -50,6 +59,11 @@ def argparser():
     parser.add_argument('--breakdown',     action='store_true',                 help=_h_breakdown)
     parser.add_argument('--containers',    action='store_true',                 help=_h_containers)
     parser.add_argument('-t', '--tags',    type=str, nargs='+',                 help=_h_tags)
+    parser.add_argument('--nthreads',      type=int, default=8,                 help=_h_nthreads)
+    parser.add_argument('--top',           type=int,                            help=_h_top)
+    parser.add_argument('--history',       type=str,                            help=_h_history)
+    parser.add_argument('--since',         type=str,                            help=_h_since)
+    parser.add_argument('--fromrules',     action='store_true',                 help=_h_fromrules)
 
     return parser.parse_args()
 
@@ -58,11 +72,536 @@ def get_account_limits(usr):
     Method to get the account limits for the user
     """
     disk_type_to_acc_limit = {}
-    for disktype, info in acccl.get_global_account_limits(usr).items():
+    for disktype, info in get_client().get_global_account_limits(usr).items():
         size, units = bytes_to_best_units(info['limit'], ensure='TB')
         disk_type_to_acc_limit[disktype.replace('type=','')] = (size, units)
     return disk_type_to_acc_limit
 
+def get_rse_usage(usr, rse):
+    """
+    Method to get the local usage of a user on one RSE, None if not retrievable
+    """
+    try:
+        return next(get_client().get_local_account_usage(usr, rse))
+    except:
+        return None
+
+def get_account_usage(usr, rses, nthreads=8):
+    '''
+    Method to get the local usage of a user on a set of RSEs. The usage on all
+    RSEs is listed in one call; if the listing fails, the RSEs are queried
+    one by one concurrently.
+
+    Parameters
+    ----------
+    usr: str
+        Rucio account to get the usage of
+    rses: iterable
+        Names of the RSEs to get the usage on
+    nthreads: int
+        Number of RSEs to query concurrently if the account-wide listing fails
+
+    Returns
+    -------
+    rse_to_usage: dict
+        Dictionary mapping each RSE with a retrievable usage to its usage
+    '''
+    rses = list(rses)
+    try:
+        rse_to_usage = {usage['rse']: usage for usage in get_client().get_local_account_usage(usr)}
+        return {rse: rse_to_usage[rse] for rse in rses if rse in rse_to_usage}
+    except Exception as e:
+        print(f"WARNING:: Could not list the usage of {usr} on all RSEs ({e}), querying them one by one")
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        usages = executor.map(lambda rse: get_rse_usage(usr, rse), rses)
+        return {rse: usage for rse, usage in zip(rses, usages) if usage is not None}
+
+# ===============  DID sizes per RSE ================
+# Edges of the bins of the size histograms, 4 per decade from 1 kB to 1 PB
+_size_bin_edges = np.logspace(3, 15, 49)
+
+class RSEDidSizes:
+    '''
+    Class to collect the DIDs with a rule on each RSE and their sizes. Either
+    all DIDs are kept, or only the K largest of each RSE in a heap, so that
+    memory grows with K rather than with the number of DIDs. A histogram of
+    the sizes of all the DIDs is filled with NumPy in batches.
+    '''
+    _batch_size = 65536
+
+    def __init__(self, top=None, sink=None):
+        '''
+        Parameters
+        ----------
+        top: int
+            Number of largest DIDs to keep per RSE, None to keep all of them
+        sink: callable
+            Called as sink(rse, did, size) for every DID added, e.g. to
+            store it somewhere else
+        '''
+        self.top  = top
+        self.sink = sink
+        self.dids_sizes = defaultdict(list)
+        self.ndids  = defaultdict(int)
+        self.nbytes = defaultdict(int)
+        self.counts = defaultdict(lambda: np.zeros(len(_size_bin_edges)+1, dtype=np.int64))
+        self.batch  = defaultdict(list)
+
+    def add(self, rse, did, size):
+        '''
+        Method to add a DID and its size to an RSE
+
+        Parameters
+        ----------
+        rse: str
+            RSE (regex) the DID has a rule on
+        did: str
+            Name of the DID, as scope:name
+        size: int
+            Size of the DID in bytes
+        '''
+        if self.sink is not None:   self.sink(rse, did, size)
+        self.ndids[rse]  += 1
+        self.nbytes[rse] += size
+
+        batch = self.batch[rse]
+        batch.append(size)
+        if len(batch) >= self._batch_size:  self._fill_histogram(rse)
+
+        if self.top is None:
+            self.dids_sizes[rse].append((did, size))
+        elif len(self.dids_sizes[rse]) < self.top:
+            heapq.heappush(self.dids_sizes[rse], (size, did))
+        else:
+            heapq.heappushpop(self.dids_sizes[rse], (size, did))
+
+    def _fill_histogram(self, rse):
+        # Bin 0 is below the first edge, and the last bin above the last edge
+        bins = np.searchsorted(_size_bin_edges, np.asarray(self.batch[rse], dtype=np.float64), side='right')
+        self.counts[rse] += np.bincount(bins, minlength=len(_size_bin_edges)+1)
+        self.batch[rse] = []
+
+    def rses(self):
+        """
+        Method to get the RSEs with DIDs
+        """
+        return list(self.ndids.keys())
+
+    def largest(self, rse):
+        '''
+        Method to get the DIDs kept for an RSE sorted by decreasing size
+
+        Parameters
+        ----------
+        rse: str
+            RSE (regex) to get the DIDs of
+
+        Returns
+        -------
+        dids_sizes: list
+            List of (did, size) tuples
+        '''
+        if self.top is None:
+            return sorted(self.dids_sizes[rse], key=lambda x: x[1], reverse=True)
+        return sorted(((did, size) for size, did in self.dids_sizes[rse]), key=lambda x: x[1], reverse=True)
+
+    def histogram(self, rse):
+        '''
+        Method to get the histogram of the sizes of all DIDs added to an RSE
+
+        Parameters
+        ----------
+        rse: str
+            RSE (regex) to get the histogram of
+
+        Returns
+        -------
+        histogram: list
+            List of {'low', 'high', 'count'} dictionaries of the non-empty bins,
+            with the bin edges in bytes (None for an unbounded edge)
+        '''
+        if self.batch[rse]: self._fill_histogram(rse)
+        edges = [None] + [float(edge) for edge in _size_bin_edges] + [None]
+        return [{'low': edges[i], 'high': edges[i+1], 'count': int(count)}
+                for i, count in enumerate(self.counts[rse]) if count > 0]
+
+# ===============  Usage history ================
+_history_schema = '''
+CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY AUTOINCREMENT, taken_at TEXT NOT NULL, users TEXT NOT NULL,
+                                      options TEXT);
+CREATE TABLE IF NOT EXISTS rse_usage (snapshot INTEGER NOT NULL, account TEXT NOT NULL, rse TEXT NOT NULL,
+                                      bytes INTEGER, bytes_limit INTEGER);
+CREATE TABLE IF NOT EXISTS did_sizes (snapshot INTEGER NOT NULL, rse TEXT NOT NULL, did TEXT NOT NULL, bytes INTEGER);
+CREATE INDEX IF NOT EXISTS rse_usage_snapshot ON rse_usage (snapshot, account);
+CREATE INDEX IF NOT EXISTS did_sizes_snapshot ON did_sizes (snapshot, rse);
+'''
+# Format of the snapshot times (UTC), which sorts like the times themselves
+_history_time_format = '%Y-%m-%dT%H:%M:%S'
+
+def open_history(path):
+    '''
+    Method to open the SQLite file holding the snapshots of the reports,
+    creating its tables if needed.
+
+    Parameters
+    ----------
+    path: str
+        Path to the SQLite file
+
+    Returns
+    -------
+    conn: sqlite3.Connection
+        Connection to the history
+    '''
+    conn = sqlite3.connect(path)
+    conn.executescript(_history_schema)
+    # Histories written before the options were stored get the column, and
+    # their snapshots (without options) are never compared to
+    if 'options' not in [row[1] for row in conn.execute('PRAGMA table_info(snapshots)')]:
+        conn.execute('ALTER TABLE snapshots ADD COLUMN options TEXT')
+    return conn
+
+def snapshot_options(regexes, scopes, rses, only_cont, from_rules):
+    '''
+    Method to get the options that select the DIDs and RSEs of a report, in
+    the form stored with its snapshot. Reports are only compared to snapshots
+    taken with the same options, since otherwise DIDs would show up as new or
+    removed just because they were (not) selected.
+
+    Parameters
+    ----------
+    regexes: list
+        Regexes of the DID names
+    scopes: list
+        Scopes of the DIDs
+    rses: list
+        Regexes of the RSEs
+    only_cont: bool
+        Whether only containers are processed
+    from_rules: bool
+        Whether the breakdown is built from the rules of the users
+
+    Returns
+    -------
+    options: str
+        The options as JSON, with the lists sorted
+    '''
+    return json.dumps({'regexes': sorted(regexes), 'scopes': sorted(scopes), 'rses': sorted(rses),
+                       'containers': bool(only_cont), 'fromrules': bool(from_rules)}, sort_keys=True)
+
+def find_snapshot(conn, users, options, since, table):
+    '''
+    Method to find the snapshot of the same users and options to compare a
+    report to.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection to the history
+    users: list
+        Rucio accounts the report is for
+    options: str
+        Options of the report, from snapshot_options
+    since: str
+        "last" for the latest snapshot, or a UTC date for the latest
+        snapshot taken at or before it
+    table: str
+        Only consider snapshots with rows in this table ('rse_usage' or 'did_sizes')
+
+    Returns
+    -------
+    (snapshot, taken_at): tuple
+        Id and time of the snapshot, or None if there is none
+    '''
+    query = f'SELECT id, taken_at FROM snapshots WHERE users = ? AND options = ? AND EXISTS (SELECT 1 FROM {table} WHERE snapshot = snapshots.id)'
+    params = [','.join(sorted(users)), options]
+    if since != 'last':
+        query += ' AND taken_at <= ?'
+        params.append(datetime.fromisoformat(since).strftime(_history_time_format))
+    row = conn.execute(query + ' ORDER BY taken_at DESC, id DESC LIMIT 1', params).fetchone()
+    if row is None: return None
+    return row[0], datetime.strptime(row[1], _history_time_format)
+
+def add_snapshot(conn, users, options):
+    '''
+    Method to start a new snapshot of the users in the history. Its rows
+    are only committed with conn.commit() once the report is complete.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection to the history
+    users: list
+        Rucio accounts the report is for
+    options: str
+        Options of the report, from snapshot_options
+
+    Returns
+    -------
+    snapshot: int
+        Id of the new snapshot
+    '''
+    taken_at = datetime.now(timezone.utc).strftime(_history_time_format)
+    cursor = conn.execute('INSERT INTO snapshots (taken_at, users, options) VALUES (?, ?, ?)',
+                          (taken_at, ','.join(sorted(users)), options))
+    return cursor.lastrowid
+
+def read_rse_usage(conn, snapshot, usr):
+    """
+    Method to get the bytes used by a user per RSE in a snapshot
+    """
+    rows = conn.execute('SELECT rse, bytes FROM rse_usage WHERE snapshot = ? AND account = ?', (snapshot, usr))
+    return dict(rows)
+
+def read_did_sizes(conn, snapshot):
+    """
+    Method to get the DIDs and their sizes per RSE regex in a snapshot
+    """
+    rse_to_did_sizes = defaultdict(dict)
+    for rse, did, size in conn.execute('SELECT rse, did, bytes FROM did_sizes WHERE snapshot = ?', (snapshot,)):
+        rse_to_did_sizes[rse][did] = size
+    return rse_to_did_sizes
+
+def rules_unchanged_since(rules, when):
+    '''
+    Method to check that none of the rules was created or updated after a time.
+
+    Parameters
+    ----------
+    rules: list
+        Rules as returned by rucio
+    when: datetime
+        Time to check against (naive, UTC like the rule times)
+
+    Returns
+    -------
+    unchanged: bool
+        True if all the rules are older than the time, False if any is
+        newer or has no time we can read
+    '''
+    for rule in rules:
+        updated_at = rule.get('updated_at')
+        if not isinstance(updated_at, datetime) or updated_at >= when: return False
+    return True
+
+def signed_best_units(delta):
+    """
+    Method to convert a change in bytes to the best units, keeping its sign
+    """
+    size, units = bytes_to_best_units(abs(delta))
+    return f'{"-" if delta < 0 else "+"}{size:.2f} {units}'
+
+def did_deltas(previous, current):
+    '''
+    Method to compare the DIDs and sizes of an RSE between two snapshots.
+
+    Parameters
+    ----------
+    previous: dict
+        DIDs to their sizes in the earlier snapshot
+    current: dict
+        DIDs to their sizes now
+
+    Returns
+    -------
+    deltas: dict
+        Lists of the new (did, size), grown and shrunk (did, old size,
+        new size) and removed (did, size) DIDs
+    '''
+    deltas = {'new': [], 'grown': [], 'shrunk': [], 'removed': []}
+    for did, size in current.items():
+        if did not in previous:             deltas['new'].append((did, size))
+        elif size > previous[did]:          deltas['grown'].append((did, previous[did], size))
+        elif size < previous[did]:          deltas['shrunk'].append((did, previous[did], size))
+    for did, size in previous.items():
+        if did not in current:              deltas['removed'].append((did, size))
+    return deltas
+
+def write_did_deltas(rse_to_did_sizes_before, rse_to_did_sizes_now, outdir):
+    '''
+    Method to write the changes of the DIDs on each RSE since a snapshot
+    to rse_<RSE>_dids_delta.txt, and a summary of them to rse_delta.json.
+
+    Parameters
+    ----------
+    rse_to_did_sizes_before: dict
+        RSE regexes to DIDs to their sizes in the snapshot
+    rse_to_did_sizes_now: dict
+        RSE regexes to DIDs to their sizes in this report
+    outdir: str
+        Directory to write the files to
+    '''
+    delta_summary = {}
+    for rse in set(rse_to_did_sizes_before) | set(rse_to_did_sizes_now):
+        current = rse_to_did_sizes_now.get(rse, {})
+        deltas  = did_deltas(rse_to_did_sizes_before.get(rse, {}), current)
+
+        with open(f'{outdir}/rse_{rse}_dids_delta.txt', 'w') as f:
+            for did, size in sorted(deltas['new'], key=lambda x: x[1], reverse=True):
+                f.write(f'NEW {did} {signed_best_units(size)} \n')
+            for kind in ['grown', 'shrunk']:
+                for did, old, new in sorted(deltas[kind], key=lambda x: abs(x[2]-x[1]), reverse=True):
+                    f.write(f'{kind.upper()} {did} {signed_best_units(new-old)} \n')
+            for did, size in sorted(deltas['removed'], key=lambda x: x[1], reverse=True):
+                f.write(f'REMOVED {did} {signed_best_units(-size)} \n')
+
+        net = sum(current.values()) - sum(rse_to_did_sizes_before.get(rse, {}).values())
+        delta_summary[rse] = {kind: len(dids) for kind, dids in deltas.items()}
+        delta_summary[rse]['net'] = signed_best_units(net)
+        print(f"INFO:: {rse}: {len(deltas['new'])} new, {len(deltas['grown'])} grown, {len(deltas['shrunk'])} shrunk, "
+              f"{len(deltas['removed'])} removed DIDs, net {delta_summary[rse]['net']}")
+
+    with open(f'{outdir}/rse_delta.json', 'w') as f:
+        json.dump(delta_summary, f, indent=2)
+
+def did_breakdown(did, scope, rses, tags, known_sizes=None, known_since=None):
+    '''
+    Method to get what the breakdown needs to know about a DID, fetching
+    its rules and its size only once.
+
+    Parameters
+    ----------
+    did: str
+        Name of the dataset
+    scope: str
+        Scope of the dataset
+    rses: list
+        Regexes of the RSEs to look for rules on
+    tags: list
+        Regexes to break down the space used by
+    known_sizes: dict
+        Sizes of DIDs in an earlier snapshot, reused if the rules of the DID
+        did not change since known_since. Files attached to or detached from
+        the DID since then without a rule change are not seen, so a reused
+        size can be stale
+    known_since: datetime
+        Time of the snapshot the known sizes are from
+
+    Returns
+    -------
+    breakdown: tuple
+        (scope, did, size, matching tags, RSE regexes with a rule), or None
+        if the DID has no rule on any of the RSEs
+    '''
+    didcl = get_client()
+    rules = list(didcl.list_did_rules(scope, did.replace('/','')))
+    rule_rses = [rule.get("rse_expression") for rule in rules]
+
+    # RSE regexes matched by any rule of the dataset
+    rses_with_rule = [rse for rse in rses if any(re.match(rse, rule_rse) is not None for rule_rse in rule_rses)]
+    # Skip if it doesn't have a rule on any of the requested RSEs
+    if len(rses_with_rule) == 0: return None
+
+    matching_tags = [tag for tag in tags if re.match(tag, did) is not None]
+    # Only list the files of DIDs whose rules changed since the snapshot
+    if known_sizes and f'{scope}:{did}' in known_sizes and rules_unchanged_since(rules, known_since):
+        ds_size = known_sizes[f'{scope}:{did}']
+    else:
+        ds_size = dataset_size(did, scope, didcl)
+
+    return (scope, did, ds_size, matching_tags, rses_with_rule)
+
+def rules_breakdown(users, regexes, scopes, rses, tags, only_cont, outdir, rse_dids, known_sizes=None, known_since=None):
+    '''
+    Method to build the breakdown of the space used on the RSEs from the
+    rules of the users, streaming each account's rules once. The size of a
+    DID is the byte count of its rule, and its files are only listed if the
+    rule has no byte count and changed since the snapshot of known_sizes.
+    A summary per RSE expression of the bytes and
+    locks of the rules, next to the usage reported for the account, is
+    written to rules_usage_<user>.json.
+
+    Parameters
+    ----------
+    users: list
+        Rucio accounts to get the rules of
+    regexes: list
+        Regexes the DID names must match
+    scopes: list
+        Scopes the DIDs must be in
+    rses: list
+        Regexes of the RSEs to report on
+    tags: list
+        Regexes to break down the space used by
+    only_cont: bool
+        Only consider rules on containers, instead of rules on datasets
+    outdir: str
+        Directory to write the summaries to
+    rse_dids: RSEDidSizes
+        Collector to add the DIDs with rules on the RSEs and their sizes to
+    known_sizes: dict
+        Sizes of DIDs in an earlier snapshot
+    known_since: datetime
+        Time of the snapshot the known sizes are from
+
+    Returns
+    -------
+    scope_to_tag_to_size: dict
+        Mapping from scopes to tags to total sizes
+    '''
+    scope_to_tag_to_size = defaultdict(lambda: defaultdict(float))
+    did_type = 'CONTAINER' if only_cont else 'DATASET'
+
+    # DIDs already counted for a tag, and for an RSE regex
+    tagged_dids, counted_dids = set(), set()
+    for usr in users:
+        print(f"INFO:: Streaming the rules of user {usr}")
+        # Usage of the account on all the RSEs in one call
+        rse_to_usage = {usage['rse']: usage for usage in get_client().get_local_account_usage(usr)}
+        rse_to_rules_usage = defaultdict(lambda: defaultdict(int))
+
+        nrules, nlisted = 0, 0
+        for rule in get_client().list_account_rules(usr):
+            scope, name, rse_expression = rule['scope'], rule['name'], rule['rse_expression']
+            # Skip the rules on DIDs we don't care about
+            if scope not in scopes: continue
+            if rule.get('did_type') not in (None, did_type): continue
+            if not any(re.match(regex, name) is not None for regex in regexes): continue
+            rses_with_rule = [rse for rse in rses if re.match(rse, rse_expression) is not None]
+            if len(rses_with_rule) == 0: continue
+
+            # Only list the files if the rule doesn't know its size
+            ds_size = rule.get('bytes')
+            if ds_size is None and known_sizes and f'{scope}:{name}' in known_sizes and rules_unchanged_since([rule], known_since):
+                ds_size = known_sizes[f'{scope}:{name}']
+            if ds_size is None:
+                ds_size = dataset_size(name, scope, get_client())
+                nlisted += 1
+            nrules += 1
+
+            rse_to_rules_usage[rse_expression]['bytes'] += ds_size
+            rse_to_rules_usage[rse_expression]['locks_ok_cnt'] += rule.get('locks_ok_cnt') or 0
+            rse_to_rules_usage[rse_expression]['nrules'] += 1
+
+            # A DID with several rules is only counted once
+            if (scope, name) not in tagged_dids:
+                tagged_dids.add((scope, name))
+                for tag in tags:
+                    if re.match(tag, name) is not None:
+                        scope_to_tag_to_size[scope][tag] += ds_size
+            for rse in rses_with_rule:
+                if (rse, scope, name) in counted_dids: continue
+                counted_dids.add((rse, scope, name))
+                rse_dids.add(rse, f'{scope}:{name}', ds_size)
+
+        print(f"INFO:: Used {nrules} rules of user {usr}, listing the files for {nlisted} of them")
+
+        # Summarise the rules per RSE expression along with the account usage
+        rules_usage_summary = {}
+        for rse_expression, rules_usage in rse_to_rules_usage.items():
+            size, units = bytes_to_best_units(rules_usage['bytes'])
+            rules_usage_summary[rse_expression] = {'rules_size': f'{size:.2f} {units}',
+                                                   'nrules': rules_usage['nrules'],
+                                                   'locks_ok_cnt': rules_usage['locks_ok_cnt']}
+            if rse_expression in rse_to_usage:
+                used, used_units = bytes_to_best_units(rse_to_usage[rse_expression]['bytes'])
+                rules_usage_summary[rse_expression]['account_used'] = f'{used:.2f} {used_units}'
+        with open(f'{outdir}/rules_usage_{usr}.json', 'w') as f:
+            json.dump(rules_usage_summary, f, indent=2)
+
+    return scope_to_tag_to_size
+
 def run():
     """ Main method to run the script """
 
@@ -79,7 +618,20 @@ def run():
     outdir    = args.outdir
     os.makedirs(outdir, exist_ok=True)
 
+    # Open the history and start the snapshot of this report
+    history = None
+    if args.since is not None:
+        assert args.history is not None, "ERROR:: --since needs a --history to compare to"
+    if args.history is not None:
+        history  = open_history(args.history)
+        options  = snapshot_options(regexes, scopes, rses, only_cont, args.fromrules)
+        # Snapshots to compare to, found before this report is added
+        before = {table: find_snapshot(history, users, options, args.since, table) if args.since is not None else None
+                  for table in ['rse_usage', 'did_sizes']}
+        snapshot = add_snapshot(history, users, options)
+
     # Get all available RSEs
+    rsecl = get_client()
     available_rses = rsecl.list_rses()
 
     # Get the requested RSEs names from the regex
@@ -105,12 +657,12 @@ def run():
                 print(f"INFO:: {disktype} : {size} {units}")
 
             # Get the usage for each RSE
+            rse_to_usage = get_account_usage(usr, req_rses, args.nthreads)
             total_used, total_limit = 0, 0
             for rse in req_rses:
                 print(f"INFO:: Checking RSE {rse}")
-                try:
-                    usage = next(acccl.get_local_account_usage(usr, rse))
-                except:
+                usage = rse_to_usage.get(rse)
+                if usage is None:
                     print(f"WARNING:: The RSE {rse} usage is not retrievable")
                     continue
 
@@ -136,66 +688,96 @@ def run():
             with open(f'{outdir}/rse_usage_{usr}.json', 'w') as f:
                 json.dump(rse_user_summary, f, indent=2)
 
-    if not breakdown: return
-    # Get the datasets
-    dataset_handler = RucioDatasetHandler(regexes = regexes,
-                                          rses = rses,
-                                          containers = only_cont,
-                                          scopes = args.scopes)
-
-    datasets = dataset_handler.GetDatasets()
-
-
-    # Dictionary mapping scopes to tags to total sizes of datasets matching the tag
-    scope_to_tag_to_size = defaultdict(lambda: defaultdict(float))
-    # Dictionary mapping RSEs to datasets and their individual sizes
-    rse_to_dids_sizes = defaultdict(lambda: defaultdict(list))
-
-    # Loop over scopes
-    for scope, dids in datasets.items():
-        # Loop over datasets
-        for did in dids:
-
-            # Check if the dataset has a rule on any of the requested RSEs
-            did_has_rule_on_regex_rse = any(has_rule_on_rse(did, scope, rse, didcl) for rse in rses)
-            # Skip if it doesn't
-            if not did_has_rule_on_regex_rse: continue
-
-            # Loop over tags
-            for tag in tags:
-                # Skip if the tag doesn't match the dataset
-                if re.match(tag, did) is None: continue
-                # Get the size of the dataset
-                ds_size = dataset_size(did, scope, didcl)
-                # Add it to the dictionary
-                scope_to_tag_to_size[scope][tag] += ds_size
-
-            # loop over RSEs
-            for rse in rses:
-                # Check if the dataset has a rule on the RSE
-                if has_rule_on_rse(did, scope, rse, didcl):
-                    # Add the dataset and its size to the dictionary
-                    rse_to_dids_sizes[rse]['did'].append(f'{scope}:{did}')
-                    rse_to_dids_sizes[rse]['size'].append(dataset_size(did, scope, didcl))
+            if history is None: continue
+            history.executemany('INSERT INTO rse_usage VALUES (?, ?, ?, ?, ?)',
+                                [(snapshot, usr, rse, usage['bytes'], usage['bytes_limit']) for rse, usage in rse_to_usage.items()])
+            if args.since is None: continue
+            if before['rse_usage'] is None:
+                print(f"WARNING:: No usage snapshot of {usr} with the same options to compare to since {args.since}")
+                continue
+
+            # Write the change of the usage on each RSE since the snapshot
+            rse_to_bytes_before = read_rse_usage(history, before['rse_usage'][0], usr)
+            rse_to_bytes_now    = {rse: usage['bytes'] for rse, usage in rse_to_usage.items()}
+            usage_delta = {rse: signed_best_units(rse_to_bytes_now.get(rse, 0) - rse_to_bytes_before.get(rse, 0))
+                           for rse in sorted(set(rse_to_bytes_before) | set(rse_to_bytes_now))}
+            usage_delta['since'] = before['rse_usage'][1].strftime(_history_time_format)
+            with open(f'{outdir}/rse_usage_delta_{usr}.json', 'w') as f:
+                json.dump(usage_delta, f, indent=2)
+
+    if not breakdown:
+        if history is not None: history.commit()
+        return
+
+    # Sizes of the DIDs in the snapshot to compare to
+    rse_to_did_sizes_before, known_sizes, known_since = {}, None, None
+    if history is not None and args.since is not None:
+        if before['did_sizes'] is None:
+            print(f"WARNING:: No breakdown snapshot with the same options to compare to since {args.since}")
+        else:
+            rse_to_did_sizes_before = read_did_sizes(history, before['did_sizes'][0])
+            known_sizes = {did: size for did_sizes in rse_to_did_sizes_before.values() for did, size in did_sizes.items()}
+            known_since = before['did_sizes'][1]
+            print(f"INFO:: Comparing to the snapshot taken at {known_since} with {len(known_sizes)} DIDs")
+
+    # DIDs with rules on the RSEs and their sizes, added to the history as they come
+    sink = None
+    if history is not None:
+        sink = lambda rse, did, size: history.execute('INSERT INTO did_sizes VALUES (?, ?, ?, ?)', (snapshot, rse, did, size))
+    rse_dids = RSEDidSizes(args.top, sink)
+
+    if args.fromrules:
+        scope_to_tag_to_size = rules_breakdown(users, regexes, scopes, rses, tags, only_cont, outdir, rse_dids,
+                                               known_sizes, known_since)
+    else:
+        # Get the datasets
+        dataset_handler = RucioDatasetHandler(regexes = regexes,
+                                              rses = rses,
+                                              containers = only_cont,
+                                              scopes = args.scopes)
+
+        datasets = dataset_handler.GetDatasets()
+
+
+        # Dictionary mapping scopes to tags to total sizes of datasets matching the tag
+        scope_to_tag_to_size = defaultdict(lambda: defaultdict(float))
+
+        # Evaluate the datasets concurrently, each fetching its rules and size once
+        scope_dids = [(scope, did) for scope, dids in datasets.items() for did in dids]
+        with ThreadPoolExecutor(max_workers=args.nthreads) as executor:
+            breakdowns = executor.map(lambda scope_did: did_breakdown(scope_did[1], scope_did[0], rses, tags,
+                                                                          known_sizes, known_since), scope_dids)
+
+            for i, breakdown in enumerate(breakdowns):
+                draw_progress_bar(len(scope_dids), i, 'Progress for the breakdown of datasets')
+                # Skip if the dataset has no rule on any of the requested RSEs
+                if breakdown is None: continue
+                scope, did, ds_size, matching_tags, rses_with_rule = breakdown
+
+                # Add the size to the tags matching the dataset
+                for tag in matching_tags:
+                    scope_to_tag_to_size[scope][tag] += ds_size
+
+                # Add the dataset and its size to the RSEs it has a rule on
+                for rse in rses_with_rule:
+                    rse_dids.add(rse, f'{scope}:{did}', ds_size)
 
     # ======= Write the outputs to files ===========
     # Loop over RSEs and datasets stored on them
-    for rse, dids_info in rse_to_dids_sizes.items():
+    for rse in rse_dids.rses():
+        total, units = bytes_to_best_units(rse_dids.nbytes[rse])
+        print(f"INFO:: {rse}: {rse_dids.ndids[rse]} DIDs using {total:.2f} {units}")
 
         with open(f'{outdir}/rse_{rse}_dids_sizes.txt', 'w') as f:
-            dids  = dids_info['did']
-            sizes = dids_info['size']
-
-            # Zip and Sort the datasets and their sizes by size
-            zipped = zip(dids, sizes)
-            sort   = sorted(zipped, key=lambda x: x[1], reverse=True)
-
-            # Write the datasets and their sizes to a file (1x per line)
-            for elem in sort:
-                did, size = elem
+            # Write the (largest) datasets and their sizes to a file (1x per line), largest first
+            for did, size in rse_dids.largest(rse):
                 size, units = bytes_to_best_units(size)
                 f.write(f'{did} {size:.2f} {units} \n')
 
+        # Write the histogram of the sizes of all the datasets
+        with open(f'{outdir}/rse_{rse}_size_histogram.json', 'w') as f:
+            json.dump(rse_dids.histogram(rse), f, indent=2)
+
     # Loop over scopes and tags and write the total sizes to a file
     for scope, tag_to_sizes in scope_to_tag_to_size.items():
         # Loop over the tags and their sizes
@@ -209,5 +791,11 @@ def run():
     with open(f'{outdir}/tag_sizes.json', 'w') as f:
         json.dump(scope_to_tag_to_size, f, indent=2)
 
+    if history is None: return
+    # The sizes are already in the history, report the changes since the snapshot
+    history.commit()
+    if known_since is not None:
+        write_did_deltas(rse_to_did_sizes_before, read_did_sizes(history, snapshot), outdir)
+
 
 if __name__ == '__main__':  run()
\ No newline at end of file
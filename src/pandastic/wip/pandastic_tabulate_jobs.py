@@ -12,19 +12,20 @@ and the module will just make one column
 
 # Required Imports
 # System
-import sys, os, re, json
+import sys, os, re, json, math
 import argparse
+from datetime import datetime, timezone
 from collections import defaultdict
 from pprint import pprint
 import pandas as pd
-# PanDA
-# /cvmfs/atlas.cern.ch/repo/ATLASLocalRootBase/x86_64/PandaClient/1.5.9/lib/python3.6/site-packages/pandaclient/PBookCore.py
-from pandaclient import PBookCore
-from pandaclient import queryPandaMonUtils
-pbook = PBookCore.PBookCore()
-
+import numpy as np
 # Pandastic
-from utils.tools import (merge_dicts, sort_dict, nested_dict_equal, get_camp, get_dsid, get_tag, progress_bar)
+from utils.tools import (sort_dict, parse_names, progress_bar)
+from utils.matching import ( RegexMatcher )
+from utils.panda_clients import ( get_pbook )
+
+# Columns of the entries kept between runs, one entry per task, name and label
+_entries_columns = ['jeditaskid', 'name', 'label', 'dsid', 'campaign', 'sim', 'state']
 
 # ===============  ArgParsing  ===================================
 # ===============  Arg Parser Defaults ===============================
@@ -39,6 +40,9 @@ _h_outpath    = 'The file to dump information to'
 _h_bytask     = 'Should the output tabulate task status? If not, it will tabulate DID status and use regex to identify DIDs not tasks'
 _h_complete   = 'What task status should be considered complete?'
 _h_incomplete   = 'What task status should be considered complete?'
+_h_campaigns  = 'A JSON file mapping r-tags to campaign names. Default is the mc16a/d/e table'
+_h_statedir   = 'Directory to keep the tabulation state in. If a state from a previous run with the same options is found,\
+                 only tasks modified since that run are queried and applied to it'
 
 
 
@@ -51,18 +55,21 @@ def argparser():
     parser.add_argument('-o', '--outpath',     type=str, required=True,                       help=_h_outpath)
     parser.add_argument('-l', '--labels',      type=str,                           nargs='+', help=_h_labels)
     parser.add_argument('-d', '--days',        type=int, default=30,                          help=_h_days)
-    parser.add_argument('-u', '--users',       type=str, default=[pbook.username], nargs='+', help=_h_users)
+    parser.add_argument('-u', '--users',       type=str,                           nargs='+', help=_h_users)
     parser.add_argument('--complete',          type=str, default=_d_complete,      nargs='+', help=_h_complete)
     parser.add_argument('--incomplete',        type=str, default=_d_incomplete,    nargs='+', help=_h_incomplete)
     parser.add_argument('--bytask',            action='store_true',                           help=_h_bytask)
+    parser.add_argument('--campaigns',         type=str,                                      help=_h_campaigns)
+    parser.add_argument('--statedir',          type=str,                                      help=_h_statedir)
 
     return parser.parse_args()
 
 
-def process_data(jobs, tabulate_tasks, labels, regexes, state):
+def process_data(jobs, tabulate_tasks, labels, regexes, complete, memo=None, rtag_to_camp=None, entries=None):
     '''
     Method to process the data from the query and save the state of the jobs/containers
     in a dictionary. The state of a container is the state of the job that produced it.
+    A job is OK if its status is one of the complete statuses, and NOT OK otherwise.
 
     Parameters
     ----------
@@ -72,8 +79,17 @@ def process_data(jobs, tabulate_tasks, labels, regexes, state):
         The list of labels to identify the job/containers category
     regexes : list
         The list of regexes to identify the job category
-    state : str
-        The state of the job. Can be OK or NOT OK.
+    complete : list
+        The task statuses for which a job is OK
+    memo : dict
+        Mapping from task/container names to the (label, dsid, campaign, sim)
+        entries they produce. Pass the same dictionary to all calls in a run so
+        that each name is only matched and parsed once.
+    rtag_to_camp : dict
+        Mapping from r-tags to campaigns. Default is the mc16 table in utils.tools
+    entries : list
+        If given, a (jeditaskid, name, label, dsid, campaign, sim, state) tuple
+        is appended to it for every state saved
 
     Returns
     -------
@@ -83,54 +99,91 @@ def process_data(jobs, tabulate_tasks, labels, regexes, state):
 
     # Declare the dictionary to fill
     dsid_camp_sim_to_status = defaultdict(lambda: defaultdict(dict))
+    # Matcher to find which regexes match a task/container name
+    matcher = RegexMatcher(regexes)
+    if memo is None: memo = {}
+
+    # Collect the names to tabulate for each job: the taskname, or the output containers
+    # === Note datasets live in containers,
+    # multiple datasets can live in the same container ===
+    complete = set(complete)
+    jobs_names, jobs_states, jobs_ids = [], [], []
+    for job in jobs:
+        jobs_ids.append(job.get("jeditaskid"))
+        jobs_states.append("OK" if job.get("status") in complete else "NOT OK")
+        if tabulate_tasks:
+            jobs_names.append([job.get("taskname")])
+        else:
+            jobs_names.append(dict.fromkeys(ds.get("containername") for ds in job.get("datasets") if ds.get("type") == 'output'))
+
+    # Match and parse all the names not seen yet in this run in one go
+    new_names = {name for names in jobs_names for name in names if name not in memo}
+    memo.update(parse_names_entries(new_names, labels, matcher, rtag_to_camp))
+
     progress_bar(len(jobs), 0)
     # loop over the jobs
-    for i, job in enumerate(jobs):
+    for i, (names, state, taskid) in enumerate(zip(jobs_names, jobs_states, jobs_ids)):
 
         if(len(jobs) > 100):
-            if (i+1)%100 == 0: progress_bar(len(jobs), i+1, msg=f'Progress for jobs with status {state}')
+            if (i+1)%100 == 0: progress_bar(len(jobs), i+1, msg=f'Progress for jobs')
         elif len(jobs) > 10 and len(jobs) <= 100:
-            if (i+1)%10 == 0:  progress_bar(len(jobs), i+1, msg=f'Progress for jobs with status {state}')
+            if (i+1)%10 == 0:  progress_bar(len(jobs), i+1, msg=f'Progress for jobs')
         else:
-            progress_bar(len(jobs), i+1, msg=f'Progress for jobs with status {state}')
+            progress_bar(len(jobs), i+1, msg=f'Progress for jobs')
 
-        # Get the job info
-        taskid   = job.get("jeditaskid")
-        taskname = job.get("taskname")
-        status   = job.get("status")
-        datasets = job.get("datasets")
-        if tabulate_tasks:
-            # Fill the dictionary with the state of the job using appropriate keys
-            dsid_camp_sim_to_status = save_state(dsid_camp_sim_to_status, taskname, labels, regexes, state)
+        # Fill the dictionary with the state of the job using appropriate keys.
+        # Containers that don't match any regex are memoised with no entries.
+        for name in names:
+            save_state(dsid_camp_sim_to_status, name, labels, matcher, state, memo)
+            if entries is not None:
+                entries.extend((taskid, name, label, dsid, campaign, sim, state) for label, dsid, campaign, sim in memo[name])
+
+    return dict(dsid_camp_sim_to_status)
 
-        else:
 
-            # Declare a list of containers that don't match any regex
-            hated_containers = []
-            # Loop over the datasets in the job
-            for ds in datasets:
-                # Skip the dataset if it's not an output dataset
-                if ds.get("type") != 'output': continue
-                contname = ds.get("containername")
-
-                # For optimisation, skip the dataset if it's in a hated container
-                # === Note datasets live in containers,
-                # multiple datasets can live in the same container ===
-                if contname not in hated_containers:
-                    # Keep track of continer before modification
-                    dsid_to_camp_to_status_before = dsid_camp_sim_to_status
-                    dsid_camp_sim_to_status = save_state(dsid_camp_sim_to_status, contname, labels, regexes, state)
-                    # If no new entries are made to the dictionary, then the container is doesn't match any regex
-                    if nested_dict_equal(dsid_to_camp_to_status_before, dsid_camp_sim_to_status):
-                        hated_containers.append(contname)
-                        continue
-                else:
-                    continue
-
-    return dsid_camp_sim_to_status
-
-
-def save_state(dict_to_fill, task_or_did, labels, regexes, state):
+def parse_names_entries(names, labels, matcher, rtag_to_camp=None):
+    '''
+    Method to find the labels of the regexes matching each task/container name,
+    and the (dsid, campaign, sim) extracted from the names that match. The
+    extraction is done for all matching names at once with parse_names.
+
+    Parameters
+    ----------
+    names : iterable
+        The names of the tasks or containers
+    labels : list
+        The list of labels to identify the job category
+    matcher : RegexMatcher
+        The matcher built from the list of regexes to identify the job category
+    rtag_to_camp : dict
+        Mapping from r-tags to campaigns. Default is the mc16 table in utils.tools
+
+    Returns
+    -------
+    name_to_entries : dict
+        Mapping from each name to a list of (label, dsid, campaign, sim) tuples,
+        empty if no regex matches the name or no DSID or tag is found in it
+    '''
+    name_to_entries = {}
+    name_to_matching = {}
+    for name in names:
+        matching = matcher.matching(name)
+        if len(matching) == 0:  name_to_entries[name] = []
+        else:   name_to_matching[name] = matching
+
+    # Extract the DSID, campaign and sim from the matching names
+    parsed = parse_names(list(name_to_matching.keys()), rtag_to_camp)
+    for name, dsid, tag, campaign, sim in zip(parsed['name'], parsed['dsid'], parsed['tag'], parsed['campaign'], parsed['sim']):
+        if not isinstance(dsid, str) or not isinstance(tag, str):
+            print(f"WARNING:: Could not find a DSID and tag in {name}... skipping")
+            name_to_entries[name] = []
+            continue
+        name_to_entries[name] = [(labels[i], dsid, campaign, sim) for i in name_to_matching[name]]
+
+    return name_to_entries
+
+
+def save_state(dict_to_fill, task_or_did, labels, matcher, state, memo=None):
     '''
     Method to save the state of a job in a dictionary. The dictionary is
     indexed by (dsid, campaign, sim) and the value is a dictionary with
@@ -144,37 +197,33 @@ def save_state(dict_to_fill, task_or_did, labels, regexes, state):
         The name of the task
     labels : list
         The list of labels to identify the job category
-    regexes : list
-        The list of regexes to identify the job category
+    matcher : RegexMatcher
+        The matcher built from the list of regexes to identify the job category
     state : str
         The state of the job
+    memo : dict
+        Mapping from names to their entries from parse_names_entries, filled as names are seen
 
     Returns
     -------
-    dict_to_fill : dict
-        The dictionary with the state of the job saved
+    nmatched : int
+        The number of labels the name matches. Zero means
+        the name doesn't match any regex.
 
     '''
-    # Zip the labels and regexes together
-    labels_regexes_zip = zip(labels, regexes)
-    # Loop simultaneously over the labels and regexes
-    for label, regex in labels_regexes_zip:
-        # If the regex doesn't match the taskname, skip to the next regex
-        if re.match(regex, task_or_did) is None:   continue
-        # Extract the DSID, campaign and sim from the taskname
-        campaign = get_camp(task_or_did)
-        dsid     = get_dsid(task_or_did)
-        tag      = get_tag(task_or_did)
-
-        if   'a' in tag: sim = 'AFII'
-        elif 's' in tag: sim = 'FS'
-        else: sim = 'unknown'
-
+    if memo is None: memo = {}
+    entries = memo.get(task_or_did)
+    if entries is None:
+        entries = memo[task_or_did] = parse_names_entries([task_or_did], labels, matcher)[task_or_did]
+
+    for label, dsid, campaign, sim in entries:
+        # An OK job is not overridden by a NOT OK job in the same category
+        if state != 'OK' and dict_to_fill[(dsid,campaign,sim)].get(label) == 'OK':   continue
         # Fill the dictionary
         dict_to_fill[(dsid,campaign,sim)][label] = state
         dict_to_fill[(dsid,campaign,sim)][label+ ' Name'] = task_or_did
 
-    return dict_to_fill
+    return len(entries)
 
 
 def fill_missing_state(dict_to_fill, labels):
@@ -207,54 +256,130 @@ def fill_missing_state(dict_to_fill, labels):
                 dict_to_fill[k][label] = 'NOT OK'
 
 
-def prepare_multiindex_for_export(df):
+def entries_to_dict(entries):
+    '''
+    Method to build the (dsid, campaign, sim) to status dictionary from the
+    entries of the tabulation. Like when merging the completed and not
+    completed jobs, an OK entry is preferred over a NOT OK one.
+
+    Parameters
+    ----------
+    entries : pandas DataFrame
+        The entries with columns jeditaskid, name, label, dsid, campaign, sim, state
 
+    Returns
+    -------
+    dsid_camp_sim_to_status : dict
+        The dictionary with the state of the jobs saved.
+    '''
+    ok_first = entries.iloc[(entries['state'] != 'OK').argsort(kind='stable')]
+    best = ok_first.drop_duplicates(subset=['dsid', 'campaign', 'sim', 'label'])
+
+    dsid_camp_sim_to_status = defaultdict(dict)
+    for _, name, label, dsid, campaign, sim, state in best[_entries_columns].itertuples(index=False):
+        dsid_camp_sim_to_status[(dsid,campaign,sim)][label] = state
+        dsid_camp_sim_to_status[(dsid,campaign,sim)][label+ ' Name'] = name
+
+    return dict(dsid_camp_sim_to_status)
+
+
+def read_tabulation_state(statedir, options):
     '''
-    The code takes a pandas DataFrame as input and returns a new DataFrame
-    that has a flattened multi-index, suitable for export.
-    It sorts the input DataFrame by the first index level, then by the second index level
-    and so on, until it reaches the last index level. After each sort,
-    it adds the current index level to the DataFrame as a new column and removes
-    duplicates by replacing the values in the newly added column with NaN where necessary.
-    Finally, it resets the index and drops it, so the output DataFrame only contains the data.
+    Method to read the entries and the watermark saved by a previous run.
 
     Parameters
     ----------
-    df : pandas DataFrame
-        The DataFrame to be flattened
+    statedir : str
+        The directory the state is kept in
+    options : dict
+        The options of the current run. The state is only used if it was
+        produced with the same options.
 
     Returns
     -------
-    new_df : pandas DataFrame
-        The flattened DataFrame
+    (entries, watermark) : tuple
+        The entries as a pandas DataFrame and the time of the previous run as
+        a datetime, or (None, None) if no usable state is found
+    '''
+    entries_path, meta_path = f'{statedir}/tabulate_entries.parquet', f'{statedir}/tabulate_state.json'
+    if not (os.path.exists(entries_path) and os.path.exists(meta_path)):
+        return (None, None)
+
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta.get('options') != options:
+        print(f"WARNING:: The state in {statedir} was made with different options, rebuilding the table from scratch")
+        return (None, None)
+
+    entries = pd.read_parquet(entries_path)
+    if list(entries.columns) != _entries_columns:
+        print(f"WARNING:: The state in {statedir} was made by an older version, rebuilding the table from scratch")
+        return (None, None)
+
+    return (entries, datetime.fromisoformat(meta['watermark']))
+
+
+def write_tabulation_state(statedir, entries, watermark, options):
+    '''
+    Method to save the entries of the tabulation and the time of the
+    queries so the next run only needs the tasks modified since then.
+
+    Parameters
+    ----------
+    statedir : str
+        The directory to keep the state in
+    entries : pandas DataFrame
+        The entries with columns jeditaskid, name, label, dsid, campaign, sim, state
+    watermark : datetime
+        The time the PanDA queries of this run were made
+    options : dict
+        The options of the current run
     '''
+    os.makedirs(statedir, exist_ok=True)
+    entries.to_parquet(f'{statedir}/tabulate_entries.parquet', index=False)
+    with open(f'{statedir}/tabulate_state.json', 'w') as f:
+        json.dump({'watermark': watermark.isoformat(), 'options': options}, f, indent=2)
 
-    # Create a copy of the dataframe
-    new_df = df.copy()
 
-    # Loop over the indicies in reverse order
-    for i in range(df.index.nlevels, 0, -1):
-        # Sort the dataframe by the current index level
-        new_df = new_df.sort_index(level=i-1)
+def export_multiindex_to_csv(df, outpath, chunksize=100000):
+    '''
+    The code takes a pandas DataFrame with a multi-index and writes it to a
+    csv file with the index levels as the first columns. The rows are sorted
+    by the index levels, and an index value is left blank when it (and the
+    values of the levels before it) repeats the one of the previous row.
+
+    The rows are visited in sorted order through a single argsort of the
+    index and written in chunks, so only one chunk is copied at a time.
 
-    # Declare a dictionary to store the columns to replace
-    replace_cols = dict()
+    Parameters
+    ----------
+    df : pandas DataFrame
+        The DataFrame to be exported
+    outpath : str
+        The path of the csv file to write
+    chunksize : int
+        The number of rows to write at a time
+    '''
+    # Row positions in the order of the sorted index
+    order = df.index.argsort()
+    names = list(df.index.names)
 
-    # Loop over the indicies again(again from inside out)
-    for i in range(new_df.index.nlevels):
-        # Get the values for the current index level
-        idx = new_df.index.get_level_values(i)
-        # Add the current index level as a new column
-        new_df.insert(i, idx.name, idx)
-        # Replace the values in the newly added column with NaN where duolicates occur
-        replace_cols[idx.name] = new_df[idx.name].where(~new_df.duplicated(subset=new_df.index.names[:i+1]))
+    # Index values of the last row written, to compare the next chunk with
+    previous = None
+    for start in range(0, max(len(order), 1), chunksize):
+        chunk = df.iloc[order[start:start+chunksize]]
+        levels = chunk.index.to_frame(index=False)
 
-    # Replace the values in the newly added columns
-    for col, ser in replace_cols.items():
-        new_df[col] = ser
+        # Is each level value the same as in the previous row?
+        shifted = levels.shift(1)
+        if previous is not None:    shifted.iloc[0] = previous
+        same = (levels == shifted).to_numpy()
+        # A value is blanked only if all the levels up to it repeat
+        repeated = np.logical_and.accumulate(same, axis=1)
+        if len(levels) != 0:    previous = levels.iloc[-1].to_numpy()
 
-    # Reset the index and drop it
-    return new_df.reset_index(drop=True)
+        out = pd.concat([levels.mask(repeated), chunk.reset_index(drop=True)], axis=1)
+        out.to_csv(outpath, index=False, mode='w' if start == 0 else 'a', header=(start == 0))
 
 
 def run():
@@ -264,17 +389,16 @@ def run():
     # Parse the command line arguments
     args = argparser()
 
-    # Get the list of users
-    users = args.users
+    # Get the list of users, the user of the grid proxy by default
+    users = args.users if args.users is not None else [get_pbook().username]
     # Get the number of days to query
     days = args.days
     # Get the output path for the summary
     outpath = args.outpath
     os.makedirs('/'.join(outpath.split('/')[:-1]), exist_ok=True)
 
-    # Get the list of what defines complete and incomplete jobs
-    complete = '|'.join(args.complete)
-    incomplete = '|'.join(args.incomplete)
+    # Get the list of what defines complete and incomplete jobs, to query both at once
+    statuses = '|'.join(dict.fromkeys(args.complete + args.incomplete))
 
     # Get the list of labels that categorise each regex, ensure list is same length as regexes
     if args.labels is not None:
@@ -282,34 +406,59 @@ def run():
     else:
         args.labels = args.regexes
 
-    # Declare lists to store the data from the queries
-    all_done, all_notdone = [], []
+    # Look for the state of a previous run, and only query the tasks modified since then
+    statedir = args.statedir
+    options  = {'regexes': args.regexes, 'labels': args.labels, 'users': users, 'bytask': args.bytask,
+                'complete': args.complete, 'incomplete': args.incomplete, 'campaigns': args.campaigns}
+    prev_entries, watermark = (None, None)
+    if statedir is not None:
+        prev_entries, watermark = read_tabulation_state(statedir, options)
+    if watermark is not None:
+        days = max(1, math.ceil((datetime.now(timezone.utc) - watermark).total_seconds()/86400))
+        print(f"INFO:: Found the state of the run at {watermark}, only looking for tasks modified in the last {days} days")
+    query_time = datetime.now(timezone.utc)
+
+    # Declare a list to store the data from the queries
+    all_tasks = []
+
+    from pandaclient import queryPandaMonUtils
 
     print("INFO:: Querying PanDAs for jobs...")
     # loop over the users
     for user in users:
-        # Query the PanDAs for the jobs that are completed
-        _, done_url, done_data = queryPandaMonUtils.query_tasks( username=user,
-                                                                 days=days,
-                                                                 status=complete)
-
-        all_done.extend(done_data)
-
-        print(f"INFO:: PanDAs query URL for done tasks from user {user}: {done_url}")
-
-        # Query the PanDAs for the jobs that are not completed
-        _, notdone_url, notdone_data = queryPandaMonUtils.query_tasks( username=user,
-                                                                       days=days,
-                                                                       status=incomplete)
-
-        print(f"INFO:: PanDAs query URL for not-done tasks from user {user}: {notdone_url}")
-        all_notdone.extend(notdone_data)
-
-    # Build the dictionary for all_done and all_notdone jobs which maps the (DSID, CAMP, TAG) to the state (OK/NOT OK)
-    # and then merge the two dictionaries
-    print("INFO:: Merging completed and not completed jobs into one dictionary")
-    all_jobs = merge_dicts( process_data(all_done, args.bytask, args.labels, args.regexes, "OK"),
-                            process_data(all_notdone, args.bytask, args.labels, args.regexes, "NOT OK"))
+        # Query the PanDAs for the jobs that are completed or not completed
+        _, url, data = queryPandaMonUtils.query_tasks( username=user,
+                                                       days=days,
+                                                       status=statuses)
+
+        print(f"INFO:: PanDAs query URL for tasks from user {user}: {url}")
+        all_tasks.extend(data)
+
+    # Build the dictionary which maps the (DSID, CAMP, TAG) to the state (OK/NOT OK),
+    # where the tasks are split into completed and not completed by their status
+    print("INFO:: Building the dictionary of completed and not completed jobs")
+    # Get the mapping from r-tags to campaigns
+    rtag_to_camp = None
+    if args.campaigns is not None:
+        with open(args.campaigns, 'r') as f:
+            rtag_to_camp = json.load(f)
+
+    # Names are matched and parsed once for the whole run
+    memo = {}
+    new_entries = []
+    all_jobs = process_data(all_tasks, args.bytask, args.labels, args.regexes, args.complete, memo, rtag_to_camp, new_entries)
+
+    if statedir is not None:
+        entries = pd.DataFrame(new_entries, columns=_entries_columns)
+        if prev_entries is not None:
+            print(f"INFO:: Applying {len(entries)} entries from modified tasks to the {len(prev_entries)} entries of the previous run")
+            # The entries of the tasks queried again replace the ones from the previous run,
+            # and an OK entry is preferred over a NOT OK one whatever the order of the tasks
+            requeried = {task.get('jeditaskid') for task in all_tasks}
+            prev_entries = prev_entries[~prev_entries['jeditaskid'].isin(requeried)]
+            entries = pd.concat([prev_entries, entries], ignore_index=True)
+            all_jobs = entries_to_dict(entries)
+        write_tabulation_state(statedir, entries, query_time, options)
 
     print("INFO:: Fill the dictionary with the state of the jobs/dids with the state 'NOT OK' if the job is missing from the dictionary")
     # Fill the dictionary with the state of the jobs/dids with the state 'NOT OK' if the job is missing from the dictionary
@@ -325,11 +474,13 @@ def run():
 
     # Convert the dictionary to a pandas multi-index dataframe
     df = pd.DataFrame.from_dict(all_jobs, orient="index").rename_axis(["DSID", "Campaign", "FS/AFII"])
-    # Prepare the multi-index dataframe for export
-    df = prepare_multiindex_for_export(df)
+    # Save the dataframe to a parquet file next to the csv file
+    parquet_path = os.path.splitext(outpath)[0] + '.parquet'
+    print("INFO:: You will find the output as parquet in the following file: ", parquet_path)
+    df.reset_index().to_parquet(parquet_path, index=False)
     print("INFO:: You will find the output in the following file: ", outpath)
-    # Save the dataframe to a csv file
-    df.to_csv(outpath, index = False)
+    # Save the multi-index dataframe to a csv file
+    export_multiindex_to_csv(df, outpath)
 
 
 if __name__ == "__main__":  run()
@@ -1,19 +1,18 @@
 import os, json, re, urllib3
 import argparse
-# Rucio
-from rucio import client as rucio_client
-import rucio.client.uploadclient as uploadclient
+from collections import defaultdict
 # Pandastic
 from utils.tools import ( dataset_size, bytes_to_best_units, draw_progress_bar, get_lines_from_files )
 from utils.common import ( get_rses_from_regex )
+from utils.matching import ( RegexMatcher )
+from utils.rucio_clients import ( get_client, get_uploadcl )
 
-from actions.upload_actions import ( upload_file )
+from actions.upload_actions import ( upload_options, upload_files, pick_primary_rse,
+                                     compute_checksums, skip_registered,
+                                     group_small_files, pack_archives )
+from actions.replicate_actions import ( add_rule )
 
 
-# ===============  Rucio Clients ================
-uploadcl  = uploadclient.UploadClient()
-rsecl      = rucio_client.rseclient.RSEClient()
-
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
@@ -33,6 +32,20 @@ _h_fromfiles = 'Files containing lists of datasets to process filtered by regex.
 _h_submit    = 'Should the code submit the upload jobs? Default is to run dry'
 _h_filtds    = 'Use the regex to filter dataset names instead of files'
 _h_nods      = 'Do not assume that the names of the files are <dataset>/<file>'
+_h_nworkers  = 'Number of uploads to run concurrently'
+_h_rsecap    = 'Maximum number of concurrent uploads to the same RSE. Default is no limit beyond --nworkers'
+_h_retries   = 'Number of passes retrying the failed uploads. Uploads still failing are written to failed_uploads.json'
+_h_resume    = 'Compute the checksums of the files first and skip the files already registered in rucio\
+                with the same checksum and a replica on the RSE, e.g. to resume a failed upload'
+_h_nprocs    = 'Number of processes computing the checksums for --resume. Default is the number of CPUs'
+_h_archive   = 'Pack the small files of each dataset into zip archives of about this size (in MB) before\
+                uploading them. The files stay addressable in rucio as members of the archives. Archives\
+                are deleted once uploaded and registered, --resume packs them again identically'
+_h_smallfile = 'Files smaller than this size (in MB) are packed with --archive'
+_h_batchsize = 'Maximum number of files of the same dataset uploaded to an RSE with one call'
+_h_replicate = 'Upload each file once, to the RSE with the best throughput measured in earlier uploads\
+                (upload_throughput.json in the output directory) or else the first RSE, and replicate\
+                each dataset to the other RSEs with one rule'
 
 def argparser():
     '''
@@ -51,9 +64,105 @@ def argparser():
     parser.add_argument('--filtds',         action='store_true',                   help=_h_filtds)
     parser.add_argument('--nods',           action='store_true',                   help=_h_nods)
     parser.add_argument('--submit',         action='store_true',                   help=_h_submit)
+    parser.add_argument('--nworkers',       type=int,   default=1,                 help=_h_nworkers)
+    parser.add_argument('--rsecap',         type=int,                              help=_h_rsecap)
+    parser.add_argument('--retries',        type=int,   default=1,                 help=_h_retries)
+    parser.add_argument('--resume',         action='store_true',                   help=_h_resume)
+    parser.add_argument('--nprocs',         type=int,                              help=_h_nprocs)
+    parser.add_argument('--archive',        type=float,                            help=_h_archive)
+    parser.add_argument('--smallfile',      type=float, default=10,                help=_h_smallfile)
+    parser.add_argument('--batchsize',      type=int,   default=50,                help=_h_batchsize)
+    parser.add_argument('--replicate',      action='store_true',                   help=_h_replicate)
 
     return parser.parse_args()
 
+def invert_dsmap(dsmap):
+    '''
+    Method to invert a mapping from datasets to files into an index from
+    each file to its dataset, checking that no file is mapped to more
+    than one dataset.
+
+    Parameters
+    ----------
+    dsmap: dict
+        Mapping from dataset names to lists of file paths
+
+    Returns
+    -------
+    file_to_ds: dict
+        Mapping from each (normalised) file path to its dataset
+    '''
+    file_to_ds, duplicates = {}, {}
+    for ds, dsfiles in dsmap.items():
+        for file in dsfiles:
+            file = os.path.normpath(file)
+            if file_to_ds.setdefault(file, ds) != ds:
+                duplicates.setdefault(file, {file_to_ds[file]}).add(ds)
+
+    for file, datasets in duplicates.items():
+        print(f"ERROR:: File {file} is mapped to more than one dataset: {sorted(datasets)}")
+    assert len(duplicates) == 0, f"ERROR:: {len(duplicates)} files are mapped to more than one dataset in the dataset map"
+
+    return file_to_ds
+
+def walk_files(folder, matcher=None, filtds=False, no_ds=False):
+    '''
+    Method to find the files to upload under a folder, visiting each directory
+    once. Symbolic links to directories are followed, and a directory reached
+    through several links (or a link cycle) is only visited the first time.
+    Files are expected to be stored as <dataset>/<file>, so files directly
+    in the folder are skipped, unless no_ds is set.
+
+    Parameters
+    ----------
+    folder: str
+        Folder to look for files in
+    matcher: RegexMatcher
+        Matcher the files (or their datasets) must match, None to keep all files
+    filtds: bool
+        Match the dataset names instead of the file paths
+    no_ds: bool
+        Do not assume the files are stored as <dataset>/<file>
+
+    Returns
+    -------
+    files: generator
+        Generator of (dataset, path, size) tuples, with dataset None if no_ds is set
+    '''
+    # Directories to visit along with the dataset of the files in them
+    stack = [(folder, None)]
+    # (device, inode) of the directories visited already
+    visited = set()
+    while stack:
+        path, dataset = stack.pop()
+        try:
+            stat = os.stat(path)
+            entries = os.scandir(path)
+        except OSError as e:
+            print(f"WARNING:: Cannot list {path}: {e}")
+            continue
+        if (stat.st_dev, stat.st_ino) in visited:
+            entries.close()
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+
+        with entries:
+            # Files of a dataset that doesn't match can be skipped altogether
+            skip_files = (not no_ds and dataset is None) or \
+                         (filtds and matcher is not None and (dataset is None or not matcher.match_any(dataset)))
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append((entry.path, None if no_ds else entry.name))
+                    continue
+                if skip_files:   continue
+                if not filtds and matcher is not None and not matcher.match_any(entry.path): continue
+                try:
+                    size = entry.stat().st_size
+                except OSError as e:
+                    print(f"WARNING:: Cannot read {entry.path}: {e}")
+                    continue
+                yield dataset, entry.path, size
+
 def run():
     """" Main method """
     args = argparser()
@@ -61,12 +170,13 @@ def run():
     dirs      = args.dirs
     regexes   = args.regexes
     rses_rgx  = args.rses
-    rses = set()
+    # RSEs in the order of the regexes, for --replicate to pick the first one
+    rses = []
     for rse in rses_rgx:
-        rses |= get_rses_from_regex(rse, rsecl)
+        rses.extend(sorted(get_rses_from_regex(rse, get_client()) - set(rses)))
     lifetime  = args.lifetime
     scopes    = args.scopes
-    dsmapf    = args.dsmap
+    dsmapf    = args.dsmap[0] if args.dsmap is not None else None
     outdir    = args.outdir
     fromfiles = args.fromfiles
     filtds    = args.filtds
@@ -87,65 +197,182 @@ def run():
 
     print("INFO:: Regex applied to: ", 'files' if not filtds else 'datasets')
     print("INFO:: RSEs to upload to: ", rses)
+
+    # Throughput of the earlier uploads to each RSE
+    throughput_file = f'{outdir}/upload_throughput.json'
+    throughput = {}
+    if os.path.exists(throughput_file):
+        with open(throughput_file, 'r') as f:
+            throughput = json.load(f)
+
+    # Upload to one RSE and replicate to the others?
+    replicate_to = []
+    if args.replicate and len(rses) > 1:
+        primary = pick_primary_rse(rses, throughput)
+        replicate_to = [rse for rse in rses if rse != primary]
+        rses = [primary]
+        print("INFO:: Files are uploaded to: ", primary, " and replicated by rules to: ", replicate_to)
     print("INFO:: Lifetime that should be given to uploaded file (in seconds): ", lifetime)
     print("INFO:: Scopes to upload to: ", scopes)
 
     if dsmapf is not None:
-        print("INFO:: Grouping files into datasets according to the mapping in: ", dsmap)
+        print("INFO:: Grouping files into datasets according to the mapping in: ", dsmapf)
     elif no_ds is False:
         print("INFO:: Grouping files into datasets according to the folder structure: <dataset>/<file>")
     else:
         print("INFO:: Uploading files as individual files not inside datasets")
 
 
-    # Get the mapping from dataset to files
-    dsmap = {}
+    # Get the mapping from files to datasets
+    file_to_ds = {}
     if dsmapf is not None:
         with open(dsmapf, 'r') as dsmapfile:
-            dsmap = json.load(dsmapfile)
+            file_to_ds = invert_dsmap(json.load(dsmapfile))
+        print(f"INFO:: Dataset map assigns {len(file_to_ds)} files to {len(set(file_to_ds.values()))} datasets")
 
-    # Get the list of files to upload
-    all_files = []
+    # Get the files to upload, as (dataset, path, size). The regexes are applied while
+    # walking the directories, unless the datasets come from the map and are filtered
+    matcher = RegexMatcher(regexes)
     if fromfiles is not None:
-        all_files = get_lines_from_files(fromfiles)
+        prefiltered = False
+        candidates = ((None if no_ds else file.split('/')[-2], file, None) for file in get_lines_from_files(fromfiles))
     else:
-        for folder in dirs:
-            if no_ds:
-                for _, _, files in os.walk(folder):
-                    all_files.extend([f'{folder}/{file}' for file in files])
-            else:
-                for root, datasets, _ in os.walk(folder):
-                    for dataset in datasets:
-                        for _, _, files in os.walk(f'{root}/{dataset}'):
-                            all_files.extend([f'{root}/{dataset}/{file}' for file in files])
+        prefiltered = not (filtds and dsmapf is not None)
+        candidates = (candidate for folder in dirs
+                      for candidate in walk_files(folder, matcher if prefiltered else None, filtds, no_ds))
 
     nfilesuploaded = 0
     nuploads       = 0
+    # Upload items of all the files, uploaded together at the end
+    to_upload      = []
+    # DIDs (datasets, or files outside datasets) to replicate after the upload
+    to_replicate   = set()
+    # Small files of each dataset to pack into archives
+    ds_to_small_files = defaultdict(list)
 
-    for file in all_files:
-        dataset = None
-        if dsmap != {}:
-            for ds, dsfiles in dsmap.items():
-                if file in dsfiles:
-                    dataset = ds
-                    break
-        elif no_ds is False:
-            dataset = file.split('/')[-2]
-
-        if filtds:
-            if not any(re.match(regex, dataset) is not None for regex in regexes): continue
-        else:
-            if not any(re.match(regex, file) is not None for regex in regexes): continue
+    for folder_ds, file, size in candidates:
+        dataset = folder_ds
+        if dsmapf is not None:
+            dataset = file_to_ds.get(os.path.normpath(file))
 
-        if submit:
-            nuploads += upload_file(file, rses, scopes, lifetime, dataset, uploadcl)
-        else:
-            for scope in scopes:
-                for rse in rses:
-                    print(f"INFO:: Would upload {file} to {rse} in {scope} with lifetime {lifetime} and dataset {dataset}")
-                    nuploads += 1
+        if not prefiltered:
+            name = dataset if filtds else file
+            if name is None or not matcher.match_any(name): continue
 
         nfilesuploaded += 1
+        if args.archive is not None and dataset is not None:
+            size = size if size is not None else os.path.getsize(file)
+            if size < args.smallfile*1e6:
+                ds_to_small_files[dataset].append((file, size))
+                continue
+        to_upload.extend(upload_options(file, rses, scopes, lifetime, dataset))
+
+    # Pack the small files into archives, uploaded like the other files of their dataset
+    archive_to_members, narchive_uploads = {}, 0
+    if len(ds_to_small_files) != 0:
+        archives, archive_to_ds = {}, {}
+        for dataset, files in ds_to_small_files.items():
+            # Files are registered under their base names, so two files of a dataset can't share one
+            name_to_file, packable = {}, []
+            for file, size in sorted(files):
+                name = os.path.basename(file)
+                if name in name_to_file:
+                    print(f"ERROR:: {file} has the same name as {name_to_file[name]} in dataset {dataset}... skipping")
+                    nfilesuploaded -= 1
+                    continue
+                name_to_file[name] = file
+                packable.append((file, size))
+
+            for i, group in enumerate(group_small_files(packable, args.archive*1e6)):
+                # Not worth an archive
+                if len(group) == 1:
+                    to_upload.extend(upload_options(group[0], rses, scopes, lifetime, dataset))
+                    continue
+                archive = f'{outdir}/archives/{dataset}.{i:04d}.zip'
+                archives[archive], archive_to_ds[archive] = group, dataset
+
+        nsmall = sum(len(paths) for paths in archives.values())
+        if not submit:
+            for archive, paths in archives.items():
+                print(f"INFO:: Would pack {len(paths)} files into {archive} and upload it to {rses} "
+                      f"in {scopes} with dataset {archive_to_ds[archive]}")
+            narchive_uploads = len(archives)*len(rses)*len(scopes)
+        else:
+            print(f"INFO:: Packing {nsmall} small files into {len(archives)} archives")
+            for archive, members in pack_archives(archives, args.nprocs):
+                archive_to_members[archive] = members
+                to_upload.extend(upload_options(archive, rses, scopes, lifetime, archive_to_ds[archive]))
+
+    # Skip the files which are already uploaded
+    skipped = []
+    if args.resume and len(to_upload) != 0:
+        paths = list(dict.fromkeys(item['path'] for item in to_upload))
+        print(f"INFO:: Computing the checksums of {len(paths)} files")
+        checksums = compute_checksums(paths, args.nprocs)
+        to_upload, skipped = skip_registered(to_upload, checksums, get_client())
+        print(f"INFO:: Skipping {len(skipped)} uploads of files already registered with a replica on the RSE")
+
+    if not submit:
+        for item in to_upload:
+            print(f"INFO:: Would upload {item['path']} to {item['rse']} in {item['scope']} with lifetime {lifetime} "
+                  f"and dataset {item.get('dataset_name')}")
+        nuploads = len(to_upload) + narchive_uploads
+        failed = []
+    else:
+        print(f"INFO:: Running {len(to_upload)} uploads with {args.nworkers} workers")
+        nuploads, failed = upload_files(to_upload, get_uploadcl, args.nworkers, args.rsecap, args.retries, throughput,
+                                        args.batchsize)
+        os.makedirs(outdir, exist_ok=True)
+        with open(throughput_file, 'w') as f:
+            json.dump(throughput, f, indent=2)
+        if len(failed) != 0:
+            print(f"WARNING:: {len(failed)} uploads failed, see {outdir}/failed_uploads.json")
+            with open(f'{outdir}/failed_uploads.json', 'w') as f:
+                json.dump(failed, f, indent=2)
+
+    # Register the files packed in the uploaded archives as their members
+    failed_ids = set(id(item) for item in failed)
+    # Archives to keep on disk, because an upload or registration failed
+    keep_archives = set(item['path'] for item in failed)
+    # Archives uploaded now or by an earlier run (--resume), once per scope
+    archive_dids = dict.fromkeys((item['path'], item['scope']) for item in to_upload + skipped
+                                 if id(item) not in failed_ids and item['path'] in archive_to_members)
+    for path, scope in archive_dids:
+        name    = os.path.basename(path)
+        members = [dict(member, scope=scope) for member in archive_to_members[path]]
+        # Members registered by an earlier run are not registered again
+        try:
+            attached = {content.get('name') for content in get_client().list_archive_content(scope, name)}
+        except Exception:
+            attached = set()
+        members = [member for member in members if member['name'] not in attached]
+        if len(members) == 0: continue
+        try:
+            get_client().add_files_to_archive(scope, name, members)
+        except Exception as e:
+            print(f"ERROR:: Failed to register the {len(members)} files packed in {scope}:{name}")
+            print(str(e))
+            keep_archives.add(path)
+
+    # The local copies of the archives are not needed anymore
+    for archive in archive_to_members:
+        if archive not in keep_archives:    os.remove(archive)
+    if len(keep_archives & set(archive_to_members)) != 0:
+        print(f"INFO:: Kept the archives with failed uploads or registrations in {outdir}/archives")
+
+    # Only replicate the DIDs which got at least one file uploaded
+    for item in to_upload + skipped:
+        if id(item) in failed_ids: continue
+        to_replicate.add((item['scope'], item.get('dataset_name', os.path.basename(item['path']))))
+
+    # Replicate the uploaded DIDs to the other RSEs, with one rule each
+    if len(replicate_to) != 0:
+        rse_expression = '|'.join(replicate_to)
+        for scope, did in sorted(to_replicate):
+            if submit:
+                add_rule(did, rse_expression, lifetime, scope, get_client(), copies=len(replicate_to))
+            else:
+                print(f"INFO:: Would add a rule for {scope}:{did} to {rse_expression} with lifetime {lifetime}")
 
     print(f'INFO:: Will upload {nfilesuploaded} files')
     print(f'INFO:: Total number of upload requests: {nuploads} ')
@@ -0,0 +1,4 @@
+import os, sys
+
+# The modules are imported like the wip scripts do, from src/pandastic
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'pandastic'))
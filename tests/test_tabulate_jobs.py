@@ -0,0 +1,24 @@
+from wip.pandastic_tabulate_jobs import ( parse_names_entries, process_data )
+from utils.matching import ( RegexMatcher )
+from utils.tools import ( sort_dict )
+
+_good = 'user.x.410470.PhPy8EG.e6337_s3126_r10201_p4174.lvl0_out.root/'
+_nodsid = 'user.x.ttbar.PhPy8EG.e6337_s3126_r10201_p4174.lvl0_out.root/'
+_notag  = 'user.x.410471.PhPy8EG.lvl0_out.root/'
+
+def test_parse_names_entries_skips_names_without_dsid_or_tag(capsys):
+    matcher = RegexMatcher([r'.*lvl0_out.*'])
+    entries = parse_names_entries([_good, _nodsid, _notag], ['L0'], matcher)
+
+    assert entries[_good] == [('L0', '410470', 'mc16d', 'FS')]
+    assert entries[_nodsid] == []
+    assert entries[_notag] == []
+    assert capsys.readouterr().out.count('WARNING::') == 2
+
+def test_process_data_with_names_without_dsid():
+    tasks = [{'jeditaskid': i, 'status': 'done', 'taskname': f't{i}',
+              'datasets': [{'type': 'output', 'containername': name}]} for i, name in enumerate([_good, _nodsid])]
+    table = process_data(tasks, False, ['L0'], [r'.*lvl0_out.*'], ['done'])
+
+    # Only string keys, which can be sorted
+    assert list(sort_dict(table)) == [('410470', 'mc16d', 'FS')]
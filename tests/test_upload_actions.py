@@ -0,0 +1,32 @@
+import rucio.common.exception
+
+from actions.upload_actions import ( upload_options, skip_registered )
+
+class FakeReplicaClient(object):
+    """
+    Replica client knowing some files, raising like rucio if any DID looked up is unknown
+    """
+    def __init__(self, replicas):
+        self.replicas = replicas
+
+    def list_replicas(self, dids):
+        for did in dids:
+            if (did['scope'], did['name']) not in self.replicas:
+                raise rucio.common.exception.DataIdentifierNotFound(f"{did['scope']}:{did['name']}")
+        for did in dids:
+            adler, rses = self.replicas[(did['scope'], did['name'])]
+            yield {'scope': did['scope'], 'name': did['name'], 'adler32': adler, 'rses': {rse: [] for rse in rses}}
+
+def test_skip_registered_with_unregistered_files():
+    items = (upload_options('/data/ds/done.root', ['RSE_A'], ['user.x'], 3600, 'ds') +
+             upload_options('/data/ds/new.root', ['RSE_A'], ['user.x'], 3600, 'ds') +
+             upload_options('/data/ds/other_rse.root', ['RSE_A'], ['user.x'], 3600, 'ds'))
+    checksums = {'/data/ds/done.root': ('0000abcd', ''), '/data/ds/new.root': ('00001234', ''),
+                 '/data/ds/other_rse.root': ('00005678', '')}
+    replicacl = FakeReplicaClient({('user.x', 'done.root'): ('abcd', ['RSE_A']),
+                                   ('user.x', 'other_rse.root'): ('5678', ['RSE_B'])})
+
+    to_upload, skipped = skip_registered(items, checksums, replicacl, chunk_size=2)
+
+    assert [item['path'] for item in skipped] == ['/data/ds/done.root']
+    assert [item['path'] for item in to_upload] == ['/data/ds/new.root', '/data/ds/other_rse.root']